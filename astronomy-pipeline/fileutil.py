@@ -0,0 +1,31 @@
+#! /usr/bin/env python3
+"""
+File helpers shared by the pipeline scripts.
+"""
+
+import os
+import tempfile
+from contextlib import contextmanager
+
+
+###########################################
+@contextmanager
+def atomic_write(filename,suffix=""):
+    """
+    Write filename through a temporary file in the same directory that is renamed to filename when the block completes,
+    so other processes never see a partial file.  If the block raises, the temporary file is removed and filename is untouched.
+    Args:
+        filename (str): The file to write.
+        suffix (str): Suffix of the temporary file (e.g. ".npz", so numpy does not append its own).
+    Yields:
+        str: The name of the temporary file to write.
+    """
+    fd,tname=tempfile.mkstemp(suffix=suffix,dir=os.path.dirname(os.path.abspath(filename)))
+    os.close(fd)
+    try:
+        yield tname
+        os.replace(tname,filename)
+    except BaseException:
+        if (os.path.isfile(tname)):
+            os.remove(tname)
+        raise
@@ -12,11 +12,18 @@ Method to find offsets between images
 
 import os
 import argparse
+import hashlib
+import json
 import re
 import time
+from collections import OrderedDict
+import multiprocessing
 import fitsio
 import wcsutil
+from fileutil import atomic_write
+import zoff_apply
 import numpy as np
+from scipy.spatial import cKDTree
 
 
 ###########################################
@@ -34,32 +41,312 @@ def get_data(filename,verbose=0):
         print("Successfully read {:s}".format(filename))
 
     return ih,isci,imsk,iwgt
-  
+
+
+###########################################
+def get_header(filename,verbose=0):
+    """Function to obtain the SCI header without reading any pixel data
+    """
+
+    ifits=fitsio.FITS(filename,'r')
+    ih=ifits['SCI'].read_header()
+    ifits.close()
+    if (verbose > 0):
+        print("Successfully read header {:s}".format(filename))
+
+    return ih
+
 
 ###########################################
-def medclip(data,clipsig=5.0,maxiter=10,converge_num=0.0001,verbose=0):
+class ImageCache:
+    """
+    Least recently used cache of the image data needed by med_diff, keyed by filename.
+    Each entry holds the SCI header, the SCI array (plus its sidecar offset) already multiplied by the fluxscale and the WGT array.
+    Entries are evicted (oldest use first) once the total size of the cached arrays exceeds maxbytes,
+    so with the pair loop ordering each image only has to be read (and decompressed) about once.
+    Args:
+        maxbytes (int): Memory budget for the cached arrays in bytes.
+        verbose (int): The verbosity level.
+    """
+    def __init__(self,maxbytes=2048*1024**2,verbose=0):
+        self.maxbytes=maxbytes
+        self.verbose=verbose
+        self.entries=OrderedDict()
+        self.nbytes=0
+        self.hits=0
+        self.misses=0
+
+    def get(self,filename,fluxscale=1.0,zoff=0.0):
+        """
+        Return header, flux-scaled SCI (after adding zoff, the offset from a sidecar) and WGT for filename, reading the file only if it is not cached.
+        """
+        key=(filename,fluxscale,zoff)
+        if (key in self.entries):
+            self.hits+=1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        self.misses+=1
+        ih,isci,imsk,iwgt=get_data(filename,verbose=self.verbose)
+        if (zoff != 0.0):
+            isci=isci+zoff
+        isci=isci*fluxscale
+        entry=(ih,isci,iwgt)
+        self.entries[key]=entry
+        self.nbytes+=isci.nbytes+iwgt.nbytes
+        # always keep the newest entry even if it is larger than the budget on its own
+        while ((self.nbytes > self.maxbytes)and(len(self.entries) > 1)):
+            _,(_,osci,owgt)=self.entries.popitem(last=False)
+            self.nbytes-=osci.nbytes+owgt.nbytes
+        return entry
+
+
+###########################################
+def map_pixels(iwcs,jwcs,i_ix,i_iy,jnx,jny,mapper=None):
+    """
+    Transform pixel positions of image i onto the pixel grid of image j (through the sky coordinates).
+    Args:
+        iwcs, jwcs (wcsutil.WCS): The WCS of the two images.
+        i_ix, i_iy (numpy.ndarray): Pixel indices in image i.
+        jnx, jny (int): Size of image j.
+        mapper (wcsutil.PixelMapper): Optional interpolating mapper from i to j used instead of the exact transform.
+    Returns:
+        tuple: (keep, j_ix, j_iy) where keep selects the pixels of i that land inside image j and j_ix, j_iy are their (rounded) pixel indices in j.
+    """
+    if (mapper is not None):
+        jImg_ix,jImg_iy=mapper(i_ix,i_iy)
+    else:
+        iRA,iDec=iwcs.image2sky(i_ix.astype('f8'),i_iy.astype('f8'))
+        jImg_ix,jImg_iy=jwcs.sky2image(iRA,iDec)
+    jImg_ix=np.rint(jImg_ix).astype(int)
+    jImg_iy=np.rint(jImg_iy).astype(int)
+    keep=np.where(np.logical_and(np.logical_and(jImg_ix>0,jImg_ix<jnx),np.logical_and(jImg_iy>0,jImg_iy<jny)))
+    return keep,jImg_ix[keep],jImg_iy[keep]
+
+
+###########################################
+def overlap_bbox(iwcs,ishape,jwcs,jshape,nedge=16,margin=2):
+    """
+    Bounding box, in pixels of image i, of the footprint of image j (i.e. of the overlap polygon of the two images).
+    The edges of image j are sampled at nedge points each and transformed into image i, so that distortion bending the edges is followed;
+    the box is then clipped to the edges of image i.  If the edges cannot be transformed the whole of image i is returned.
+    Args:
+        iwcs, jwcs (wcsutil.WCS): The WCS of the two images.
+        ishape, jshape (tuple): Shapes (ny,nx) of the two images.
+        nedge (int): Number of points sampled along each edge of image j.
+        margin (int): Number of pixels the box is grown by on each side.
+    Returns:
+        tuple: (x0,x1,y0,y1) with image i slices [y0:y1,x0:x1] covering the overlap, or None if the footprints do not overlap.
+    """
+    jny,jnx=jshape
+    t=np.linspace(0.0,1.0,nedge)
+    ex=np.concatenate([t*jnx,np.full(nedge,float(jnx)),t*jnx,np.zeros(nedge)])
+    ey=np.concatenate([np.zeros(nedge),t*jny,np.full(nedge,float(jny)),t*jny])
+    eRA,eDec=jwcs.image2sky(ex,ey)
+    ix,iy=iwcs.sky2image(eRA,eDec)
+    iny,inx=ishape
+    if (not(np.all(np.isfinite(ix))and np.all(np.isfinite(iy)))):
+        return 0,inx,0,iny
+    x0=max(0,int(np.floor(np.min(ix)))-margin)
+    x1=min(inx,int(np.ceil(np.max(ix)))+margin+1)
+    y0=max(0,int(np.floor(np.min(iy)))-margin)
+    y1=min(iny,int(np.ceil(np.max(iy)))+margin+1)
+    if ((x0 >= x1)or(y0 >= y1)):
+        return None
+    return x0,x1,y0,y1
+
+
+###########################################
+class PixelMapCache:
+    """
+    On-disk cache of the pixel-to-pixel mapping between pairs of images.
+    For every pixel of image i that lands inside image j the flat pixel indices in i and in j are stored as a (2,n) int32 .npy file.
+    The file name is a hash of both WCS (see wcsutil.WCS.get_hash) and image shapes, so a changed header simply gives a new key,
+    and images of different bands with the same geometry share one mapping.  Files are loaded memory-mapped.
+    The mapping covers all pixels (not only those with weight > 0) so it does not depend on the weight maps.
+    Args:
+        cachedir (str): Directory holding the cached mappings (created if needed).
+        verbose (int): The verbosity level.
+    """
+    def __init__(self,cachedir,verbose=0):
+        self.cachedir=cachedir
+        self.verbose=verbose
+        os.makedirs(cachedir,exist_ok=True)
+
+    def key(self,iwcs,ishape,jwcs,jshape):
+        """Hash identifying the mapping from image i to image j"""
+        h=hashlib.sha1()
+        h.update("{:s} {:s} {:s} {:s}".format(iwcs.get_hash(),str(tuple(ishape)),jwcs.get_hash(),str(tuple(jshape))).encode())
+        return h.hexdigest()
+
+    def get(self,iwcs,ishape,jwcs,jshape):
+        """
+        Return the (2,n) array of flat pixel indices (in i, in j) of the overlap, computing and storing it if it is not cached.
+        """
+        fname=os.path.join(self.cachedir,self.key(iwcs,ishape,jwcs,jshape)+".npy")
+        if (os.path.isfile(fname)):
+            if (self.verbose > 2):
+                print("Using cached pixel map {:s}".format(fname))
+            return np.load(fname,mmap_mode='r')
+
+        iny,inx=ishape
+        jny,jnx=jshape
+        bbox=overlap_bbox(iwcs,ishape,jwcs,jshape)
+        if (bbox is None):
+            bbox=(0,0,0,0)
+        x0,x1,y0,y1=bbox
+        iImg_iy,iImg_ix=np.indices((y1-y0,x1-x0))
+        iImg_ix=np.reshape(iImg_ix,iImg_ix.size)+x0
+        iImg_iy=np.reshape(iImg_iy,iImg_iy.size)+y0
+        keep,j_ix,j_iy=map_pixels(iwcs,jwcs,iImg_ix,iImg_iy,jnx,jny)
+        pmap=np.empty((2,j_ix.size),dtype=np.int32)
+        pmap[0]=iImg_iy[keep]*inx+iImg_ix[keep]
+        pmap[1]=j_iy*jnx+j_ix
+
+        with atomic_write(fname,suffix=".npy") as tname:
+            np.save(tname,pmap)
+        if (self.verbose > 2):
+            print("Stored pixel map {:s}".format(fname))
+        return pmap
+
+
+###########################################
+class _SortedSample:
+    """
+    Data sorted once, with prefix sums, so that clipping is done by selection.
+    A clipping window |x-medval| < width is a contiguous range of the sorted values, found with two binary searches.
+    Its median is the middle element(s) of the range and the mean and variance come from the prefix sums
+    of (x-shift) and (x-shift)**2, so each clipping iteration costs O(log n) and allocates nothing.
+    """
+    def __init__(self,data):
+        self.s=np.sort(data)
+        n=self.s.size
+        # shift by the median to keep the prefix sums well conditioned
+        self.shift=self.s[n//2]
+        work=self.s-self.shift
+        self.c1=np.zeros(n+1,dtype=np.float64)
+        self.c2=np.zeros(n+1,dtype=np.float64)
+        np.cumsum(work,out=self.c1[1:])
+        np.multiply(work,work,out=work)
+        np.cumsum(work,out=self.c2[1:])
+
+    def stats(self,medval=0.0,width=np.inf):
+        """Mean, median, std and number of values with |x-medval| < width"""
+        lo=int(np.searchsorted(self.s,medval-width,side='right'))
+        hi=int(np.searchsorted(self.s,medval+width,side='left'))
+        ct=hi-lo
+        if (ct <= 0):
+            return np.nan,np.nan,np.nan,0
+        avgval=(self.c1[hi]-self.c1[lo])/ct
+        stdval=np.sqrt(max((self.c2[hi]-self.c2[lo])/ct-avgval*avgval,0.0))
+        k=lo+ct//2
+        if (ct%2 == 1):
+            medval=self.s[k]
+        else:
+            medval=0.5*(self.s[k-1]+self.s[k])
+        return avgval+self.shift,medval,stdval,ct
+
+
+###########################################
+class _BinnedSample:
+    """
+    Approximate version of _SortedSample for very large samples, which avoids the O(n log n) sort.
+    The values are counted once into bins of width tol covering [lo,hi) (plus one underflow and one overflow bin)
+    and each value is represented by the centre of its bin.  Clipping windows are rounded inward to whole bins and
+    the median is interpolated within its bin, so the median, mean and window edges are in error by at most tol.
+    stats() returns None for a window that extends past [lo,hi), in which case the caller has to fall back to the exact method.
+    """
+    def __init__(self,data,lo,hi,tol):
+        self.lo=lo
+        self.tol=tol
+        self.nbins=int(np.ceil((hi-lo)/tol))
+        self.hi=lo+self.nbins*tol
+        if (self.nbins > 10000000):
+            return
+        work=data-lo
+        work/=tol
+        np.floor(work,out=work)
+        work+=1.0
+        np.clip(work,0,self.nbins+1,out=work)
+        count=np.bincount(work.astype(np.intp),minlength=self.nbins+2)
+
+        # bin centres relative to the middle of the range
+        centre=(np.arange(self.nbins)+0.5-0.5*self.nbins)*tol
+        self.shift=0.5*(self.lo+self.hi)
+        self.c0=np.concatenate(([0],np.cumsum(count)))
+        self.c1=np.concatenate(([0.0],np.cumsum(count[1:-1]*centre)))
+        self.c2=np.concatenate(([0.0],np.cumsum(count[1:-1]*centre*centre)))
+
+    def stats(self,medval=0.0,width=np.inf):
+        """Mean, median, std and number of values with |x-medval| < width (rounded to whole bins)"""
+        if ((medval-width < self.lo)or(medval+width > self.hi)):
+            return None
+        blo=int(np.ceil((medval-width-self.lo)/self.tol))
+        bhi=int(np.floor((medval+width-self.lo)/self.tol))
+        ct=int(self.c0[bhi+1]-self.c0[blo+1])
+        if (ct <= 0):
+            return np.nan,np.nan,np.nan,0
+        avgval=(self.c1[bhi]-self.c1[blo])/ct
+        stdval=np.sqrt(max((self.c2[bhi]-self.c2[blo])/ct-avgval*avgval,0.0))
+        return avgval+self.shift,self.median(self.c0[blo+1]+0.5*ct),stdval,ct
+
+    def median(self,half):
+        """Value below which half of the counted values lie (interpolated within its bin)"""
+        k=int(np.searchsorted(self.c0,half,side='left'))-1
+        frac=(half-self.c0[k])/(self.c0[k+1]-self.c0[k])
+        return self.lo+(k-1+frac)*self.tol
+
+
+###########################################
+def medclip(data,clipsig=5.0,maxiter=10,converge_num=0.0001,verbose=0,median_tol=None,median_min=1000000):
     """
     Perform sigma clipping algorithm on the given dataset to robustly estimate its mean, median, and standard deviation.
     Sigma clipping is a technique used to identify and remove outliers from data, which can skew statistical measures. 
     The method iterates through the data, recalculating statistical measures each time and excluding data points that lie beyond a specified number of standard deviations (sigma) from the median. 
     This process is repeated until convergence is achieved or a maximum number of iterations is reached. 
     This method is useful in astronomical data analysis and other fields where it is important to mitigate the impact of outliers on statistical measures.
+    Each clipping window is an interval of values, so the data are sorted once and every iteration is a selection
+    on the sorted values (see _SortedSample).  With median_tol set, samples of at least median_min values are binned
+    instead of sorted (see _BinnedSample) and the results are approximate to within median_tol.
     Args:
         data (numpy.ndarray): The input data to be processed.
         clipsig (float): The number of standard deviations to clip the data at.
         maxiter (int): The maximum number of iterations to perform.
         converge_num (float): The convergence criterion for the algorithm.
         verbose (int): The verbosity level.
+        median_tol (float): If set, use binned (approximate) statistics with this bin width for samples of at least median_min values.
+        median_min (int): Minimum sample size for the binned statistics.
     Returns:
         tuple: A tuple containing the estimated mean, median, standard deviation, and the number of pixels used for the calculation.
     """
+    data=np.asarray(np.ravel(data),dtype=np.float64)
     ct = data.size
     iter = 0; c1 = 1.0 ; c2 = 0.0
 
-    avgval = np.mean(data)
-    medval = np.median(data)
-    sig = np.std(data)
-    wsm = np.where( abs(data-medval) < clipsig*sig )
+    sample=None
+    if ((median_tol is not None)and(ct >= median_min)):
+        # single pass mean and std of the full sample.  The median is within one std of the mean
+        # so every clipping window lies inside mean +/- (clipsig+1)*std, which is the range that gets binned.
+        avgval=np.mean(data)
+        sig=np.std(data)
+        width=(clipsig+1.0)*sig
+        sample=_BinnedSample(data,avgval-width,avgval+width,median_tol)
+        if (sample.nbins > 10000000):
+            sample=None
+        else:
+            medval=sample.median(0.5*ct)
+    if (sample is None):
+        sample=_SortedSample(data)
+        avgval,medval,sig,_ = sample.stats()
+
+    def clipstats(sample,medval,sig):
+        wstats=sample.stats(medval,clipsig*sig)
+        if (wstats is None):
+            # window left the binned range, switch to the exact method
+            sample=_SortedSample(data)
+            wstats=sample.stats(medval,clipsig*sig)
+        return sample,wstats
+
     if ((verbose > 0)and(verbose < 4)):
         print("iter,avgval,medval,sig")
     if ((verbose > 2)and(verbose < 4)):
@@ -72,11 +359,9 @@ def medclip(data,clipsig=5.0,maxiter=10,converge_num=0.0001,verbose=0):
     while (c1 >= c2) and (iter < maxiter):
         iter += 1
         lastct = ct
-        avgval = np.mean(data[wsm])
-        medval = np.median(data[wsm])
-        sig = np.std(data[wsm])
-        wsm = np.where( abs(data-medval) < clipsig*sig )
-        ct = len(wsm[0])
+        sample,(avgval,medval,sig,_) = clipstats(sample,medval,sig)
+        # number of points inside the next window
+        sample,(_,_,_,ct) = clipstats(sample,medval,sig)
         if ct > 0:
             c1 = abs(ct - lastct)
             c2 = converge_num * lastct
@@ -89,9 +374,7 @@ def medclip(data,clipsig=5.0,maxiter=10,converge_num=0.0001,verbose=0):
         # convergence warning
         print("Warning: medclip had not yet converged after {:d} iterations".format(iter))
 
-    medval = np.median(data[wsm])
-    avgval = np.mean(data[wsm])
-    stdval = np.std(data[wsm])
+    sample,(avgval,medval,stdval,ct) = clipstats(sample,medval,sig)
     if (verbose > 0):
         print(iter+1,avgval,medval,sig)
 
@@ -99,7 +382,114 @@ def medclip(data,clipsig=5.0,maxiter=10,converge_num=0.0001,verbose=0):
 
 
 ###########################################
-def med_diff(ImgDict,iImg,jImg,minpix=500,verbose=0):
+def median_error(data,ix,iy,medval,sig,clipsig=5.0,nstrata=4):
+    """
+    Analytic standard error of the median of a spatially stratified sample.
+    The sample is split into nstrata x nstrata tiles (by pixel position) and the error combines the scatter of the
+    values (within medval +/- clipsig*sig) inside each tile, so large scale structure between the tiles does not count as noise.
+    Args:
+        data (numpy.ndarray): Sample values.
+        ix, iy (numpy.ndarray): Pixel positions of the values.
+        medval, sig (float): Median and standard deviation of the clipped sample (from medclip).
+        clipsig (float): Clipping limit (in sig) for values that enter the error.
+        nstrata (int): Number of tiles along each axis.
+    Returns:
+        float: Standard error of the median.
+    """
+    ok=np.where(np.abs(data-medval) <= clipsig*sig)
+    data=data[ok]
+    if (data.size < 2):
+        return np.inf
+    tx=ix[ok]-ix.min()
+    ty=iy[ok]-iy.min()
+    tile=(tx*nstrata//(tx.max()+1))*nstrata+(ty*nstrata//(ty.max()+1))
+    n=np.bincount(tile,minlength=nstrata*nstrata).astype(np.float64)
+    s1=np.bincount(tile,weights=data,minlength=nstrata*nstrata)
+    s2=np.bincount(tile,weights=data*data,minlength=nstrata*nstrata)
+    use=n > 1
+    # sum over tiles of n_k * var_k, var_k = (s2-s1^2/n)/(n-1)
+    nvar=n[use]*(s2[use]-s1[use]**2/n[use])/(n[use]-1.0)
+    return np.sqrt(np.pi/2.0)*np.sqrt(max(np.sum(nvar),0.0))/data.size
+
+
+###########################################
+def stream_diffs(ImgDict,iImg,jImg,rowblock=512,gridstep=None,gridtol=0.01,verbose=0):
+    """
+    Pixel differences (i - j) over the overlap of two images, computed in blocks of rows with bounded memory.
+    Only the part of image i inside the footprint of image j (see overlap_bbox) is read, a block of rows at a time,
+    together with the matching sub-region of image j.  The differences of each block are appended to a running buffer,
+    so apart from the buffer of differences the memory used scales with rowblock and not with the image size.
+    Args:
+        ImgDict (dict): A dictionary containing the image data and metadata (needs 'wcs' and 'fluxscale').
+        iImg (str): The name of the first image.
+        jImg (str): The name of the second image.
+        rowblock (int): Number of rows of image i handled per block.
+        gridstep (int): If set, interpolate the transform from an exact grid with this spacing (see wcsutil.PixelMapper).
+        gridtol (float): Maximum interpolation error (pixels) allowed with gridstep.
+        verbose (int): The verbosity level.
+    Returns:
+        numpy.ndarray: Differences for the pixels with weight > 0 in both images.
+    """
+    iwcs=ImgDict[iImg]['wcs']
+    jwcs=ImgDict[jImg]['wcs']
+    inx,iny=iwcs.get_naxis()
+    jnx,jny=jwcs.get_naxis()
+    ishape=(int(iny),int(inx))
+    jshape=(int(jny),int(jnx))
+    bbox=overlap_bbox(iwcs,ishape,jwcs,jshape)
+    if (bbox is None):
+        return np.zeros(0)
+    x0,x1,y0,y1=bbox
+    if (verbose > 2):
+        print("Overlap bounding box in {:s}: x=[{:d},{:d}) y=[{:d},{:d})".format(iImg,x0,x1,y0,y1))
+
+    mapper=None
+    if (gridstep is not None):
+        mapper=wcsutil.PixelMapper(iwcs,jwcs,step=gridstep,tol=gridtol,xrange=[float(x0),float(x1)],yrange=[float(y0),float(y1)])
+        if (not(mapper.converged)):
+            print("Warning: interpolated mapping {:s} -> {:s} has error {:.4f} pixels (> {:.4f})".format(iImg,jImg,mapper.maxerr,gridtol))
+
+    ifits=fitsio.FITS(os.path.join("data",iImg),'r')
+    jfits=fitsio.FITS(os.path.join("data",jImg),'r')
+    ifs=ImgDict[iImg]['fluxscale']
+    jfs=ImgDict[jImg]['fluxscale']
+    izoff=ImgDict[iImg].get('zoff',0.0)
+    jzoff=ImgDict[jImg].get('zoff',0.0)
+    # each pixel of i in the box gives at most one difference (several can land on the same pixel of j)
+    buf=np.empty((x1-x0)*(y1-y0))
+    nbuf=0
+    for yb in range(y0,y1,rowblock):
+        yb1=min(yb+rowblock,y1)
+        iwgt=ifits['WGT'][yb:yb1,x0:x1]
+        b_iy,b_ix=np.nonzero(iwgt>0.0)
+        if (b_ix.size == 0):
+            continue
+        keep,j_ix,j_iy=map_pixels(iwcs,jwcs,b_ix+x0,b_iy+yb,jshape[1],jshape[0],mapper=mapper)
+        if (j_ix.size == 0):
+            continue
+        b_ix=b_ix[keep]
+        b_iy=b_iy[keep]
+        # only the sub-region of image j that this block lands on is read
+        jx0,jx1=j_ix.min(),j_ix.max()+1
+        jy0,jy1=j_iy.min(),j_iy.max()+1
+        j_ix=j_ix-jx0
+        j_iy=j_iy-jy0
+        jwgt=jfits['WGT'][jy0:jy1,jx0:jx1]
+        jok=np.where(jwgt[j_iy,j_ix]>0)
+        if (jok[0].size == 0):
+            continue
+        isci=(ifits['SCI'][yb:yb1,x0:x1]+izoff)*ifs
+        jsci=(jfits['SCI'][jy0:jy1,jx0:jx1]+jzoff)*jfs
+        d=isci[b_iy[jok],b_ix[jok]]-jsci[j_iy[jok],j_ix[jok]]
+        buf[nbuf:nbuf+d.size]=d
+        nbuf+=d.size
+    ifits.close()
+    jfits.close()
+    return buf[:nbuf]
+
+
+###########################################
+def med_diff(ImgDict,iImg,jImg,minpix=500,cache=None,median_tol=None,mapcache=None,gridstep=None,gridtol=0.01,rowblock=None,sample=None,seed=0,nsample=4000,verbose=0):
     """
     Calculate the median difference between two images, accounting for the overlap region.
     If there are not enough pixels to perform the calculation (fewer than minpix), 
@@ -111,6 +501,18 @@ def med_diff(ImgDict,iImg,jImg,minpix=500,verbose=0):
         iImg (str): The name of the first image.
         jImg (str): The name of the second image.
         minpix (int): The minimum number of pixels required for the calculation.
+        cache (ImageCache): Optional cache of image data so that images shared by several pairs are only read once.
+        median_tol (float): Optional error bound for the histogram median used by medclip on large overlaps.
+        mapcache (PixelMapCache): Optional on-disk cache of the pixel mapping between the two images (replaces step 4 when the mapping is cached).
+        gridstep (int): If set, step 4 interpolates the transform from an exact grid with this spacing (see wcsutil.PixelMapper).
+        gridtol (float): Maximum interpolation error (pixels) allowed with gridstep.
+        rowblock (int): If set, steps 1-5 stream the overlap region in blocks of this many rows with bounded memory (see stream_diffs; cache and mapcache are not used).
+        sample (float): If set, steps 4-6 use a regular lattice of the pixels of image i (with a seeded random origin), starting near nsample
+            pixels and halving the lattice spacing until the standard error of the median (see median_error) is below sample*std.
+            The reported number of pixels is scaled by the lattice cell area so that it still estimates the overlap.
+            Only for the in-memory path: combined with mapcache or rowblock it raises a ValueError.
+        seed (int): Seed for the lattice origin with sample (combined with the image numbers, so results do not depend on pair order).
+        nsample (int): Approximate initial number of sampled pixels with sample.
         verbose (int): The verbosity level.
     Returns:
         tuple: A tuple containing the median difference, standard deviation, and the number of pixels used for the calculation.
@@ -125,75 +527,135 @@ def med_diff(ImgDict,iImg,jImg,minpix=500,verbose=0):
 
     """
 
+    if ((sample is not None)and((rowblock is not None)or(mapcache is not None))):
+        raise ValueError("sample can not be combined with rowblock or mapcache")
+
     t0=time.time()
-    # read the two image data
-    ih,isci,imsk,iwgt=get_data(os.path.join("data",iImg))
-    jh,jsci,jmsk,jwgt=get_data(os.path.join("data",jImg))
+    clipped=None
+    nscale=1
+    if (rowblock is None):
+        # read the two image data (scaled by fluxscale)
+        if (cache is None):
+            cache=ImageCache(maxbytes=0)
+        ih,isci,iwgt=cache.get(os.path.join("data",iImg),ImgDict[iImg]['fluxscale'],ImgDict[iImg].get('zoff',0.0))
+        jh,jsci,jwgt=cache.get(os.path.join("data",jImg),ImgDict[jImg]['fluxscale'],ImgDict[jImg].get('zoff',0.0))
     t1=time.time()
     if (verbose > 2):
         print("Read images: {:.2f} ".format(t1-t0))
 
-    isci=isci*ImgDict[iImg]['fluxscale']
-    jsci=jsci*ImgDict[jImg]['fluxscale']
     t1a=time.time()
     if (verbose > 2):
         print("Scale mages: {:.2f} ".format(t1a-t1))
 
-    iwgt2=np.reshape(iwgt,iwgt.size)
-    iwsm=np.where(iwgt2>0.0)
+    if (rowblock is not None):
+        # stream the overlap region (reads only the needed rows of both images)
+        diff=stream_diffs(ImgDict,iImg,jImg,rowblock=rowblock,gridstep=gridstep,gridtol=gridtol,verbose=verbose)
+        dwsm=slice(None)
+        if (verbose > 2):
+            print("Streamed overlap differences: {:.2f} ".format(time.time()-t1a))
+    elif (mapcache is not None):
+        # overlap mapping from the cache, then remove points that are masked (have wgt=0) in image i
+        pmap=mapcache.get(ImgDict[iImg]['wcs'],isci.shape,ImgDict[jImg]['wcs'],jsci.shape)
+        i_flat=pmap[0]
+        j_flat=pmap[1]
+        iwsm=np.where(np.ravel(iwgt)[i_flat]>0.0)
+        i_flat=i_flat[iwsm]
+        j_flat=j_flat[iwsm]
+        t4=time.time()
+        if (verbose > 2):
+            print("Cached pixel map: {:.2f} ".format(t4-t1a))
 
-    t2=time.time()
-    if (verbose > 2):
-        print("Reshape images: {:.2f} ".format(t2-t1a))
+        diff=np.ravel(isci)[i_flat]-np.ravel(jsci)[j_flat]
+        dwgt=np.ravel(jwgt)[j_flat]
+        dwsm=np.where(dwgt>0)
+    else:
+        # only the part of image i inside the footprint of image j is transformed (exact checks follow in map_pixels)
+        bbox=overlap_bbox(ImgDict[iImg]['wcs'],isci.shape,ImgDict[jImg]['wcs'],jsci.shape)
+        if (bbox is None):
+            bbox=(0,0,0,0)
+        x0,x1,y0,y1=bbox
+        if (verbose > 2):
+            print("Overlap bounding box: x=[{:d},{:d}) y=[{:d},{:d}) ({:.1f}% of image)".format(x0,x1,y0,y1,100.0*(x1-x0)*(y1-y0)/isci.size))
 
-    iImg_iy, iImg_ix = np.indices(isci.shape)
-#   remove points that are masked (have wgt=0)
-    iImg_ix=np.reshape(iImg_ix,iImg_ix.size)[iwsm]
-    iImg_iy=np.reshape(iImg_iy,iImg_iy.size)[iwsm]
-    iImg_rx=iImg_ix.astype('f8')
-    iImg_ry=iImg_iy.astype('f8')
+        t2=time.time()
+        if (verbose > 2):
+            print("Reshape images: {:.2f} ".format(t2-t1a))
 
-    t3=time.time()
-    if (verbose > 2):
-        print("Form pixel arrays: {:.2f} ".format(t3-t2))
+#       remove points that are masked (have wgt=0)
+        iImg_iy,iImg_ix=np.nonzero(iwgt[y0:y1,x0:x1]>0.0)
+        iImg_ix+=x0
+        iImg_iy+=y0
 
-    iRA,iDec=ImgDict[iImg]['wcs'].image2sky(iImg_rx,iImg_ry)
-    t4a=time.time()
-    if (verbose > 2):
-        print("Transform(1) pixel arrays: {:.2f} ".format(t4a-t3))
-    jImg_ix,jImg_iy=ImgDict[jImg]['wcs'].sky2image(iRA,iDec)
-    t4=time.time()
-    if (verbose > 2):
-        print("Transform(2) pixel arrays: {:.2f} ".format(t4-t4a))
+        t3=time.time()
+        if (verbose > 2):
+            print("Form pixel arrays: {:.2f} ".format(t3-t2))
 
-    jImg_ix=np.rint(jImg_ix).astype(int)
-    jImg_iy=np.rint(jImg_iy).astype(int)
-#    print(iImg_ix.dtype)
-#    print(jImg_ix.dtype)
+        mapper=None
+        if ((gridstep is not None)and(iImg_ix.size > 0)):
+            mapper=wcsutil.PixelMapper(ImgDict[iImg]['wcs'],ImgDict[jImg]['wcs'],step=gridstep,tol=gridtol,
+                                       xrange=[float(x0),float(x1)],yrange=[float(y0),float(y1)])
+            if (not(mapper.converged)):
+                print("Warning: interpolated mapping {:s} -> {:s} has error {:.4f} pixels (> {:.4f})".format(iImg,jImg,mapper.maxerr,gridtol))
+            if (verbose > 2):
+                print("Grid mapping step {:d} max error {:.5f} pixels".format(mapper.step,mapper.maxerr))
+        if (sample is None):
+            jwsm,j_ix,j_iy=map_pixels(ImgDict[iImg]['wcs'],ImgDict[jImg]['wcs'],iImg_ix,iImg_iy,jh['NAXIS1'],jh['NAXIS2'],mapper=mapper)
+            t5=time.time()
+            if (verbose > 2):
+                print("Transform pixel arrays and mask non-overlap: {:.2f} ".format(t5-t3))
 
-    jwsm=np.where(np.logical_and(np.logical_and(jImg_ix>0,jImg_ix<jh['NAXIS1']),np.logical_and(jImg_iy>0,jImg_iy<jh['NAXIS2'])))
-    t5=time.time()
-    if (verbose > 2):
-        print("Mask non-overlap: {:.2f} ".format(t5-t4))
+            nover=j_ix.size
+            if (verbose > 2):
+                print("Preliminary number of overlaping pixels: {:d}".format(nover))
 
-    nover=jImg_ix[jwsm].size
-    if (verbose > 2):
-        print("Preliminary number of overlaping pixels: {:d}".format(nover))
+            i_ix=iImg_ix[jwsm]
+            i_iy=iImg_iy[jwsm]
 
-    j_ix=jImg_ix[jwsm]
-    j_iy=jImg_iy[jwsm]
-    i_ix=iImg_ix[jwsm]
-    i_iy=iImg_iy[jwsm]
-
-    diff=isci[i_iy,i_ix]-jsci[j_iy,j_ix]
-    dwgt=jwgt[j_iy,j_ix]
-    dwsm=np.where(dwgt>0)
+            diff=isci[i_iy,i_ix]-jsci[j_iy,j_ix]
+            dwgt=jwgt[j_iy,j_ix]
+            dwsm=np.where(dwgt>0)
+        else:
+            # lattice sample of the pixels of i, refined (spacing halved, nested lattices) until the median is precise enough
+            rng=np.random.default_rng([seed,ImgDict[iImg]['inum'],ImgDict[jImg]['inum']])
+            stride=1
+            while (iImg_ix.size >= 4*stride*stride*nsample):
+                stride*=2
+            origin=rng.integers(0,stride,size=2)
+            while True:
+                lsel=np.where(np.logical_and((iImg_ix-origin[0])%stride == 0,(iImg_iy-origin[1])%stride == 0))
+                jwsm,j_ix,j_iy=map_pixels(ImgDict[iImg]['wcs'],ImgDict[jImg]['wcs'],iImg_ix[lsel],iImg_iy[lsel],jh['NAXIS1'],jh['NAXIS2'],mapper=mapper)
+                i_ix=iImg_ix[lsel][jwsm]
+                i_iy=iImg_iy[lsel][jwsm]
+                dwsm=np.where(jwgt[j_iy,j_ix]>0)
+                i_ix=i_ix[dwsm]
+                i_iy=i_iy[dwsm]
+                diff=isci[i_iy,i_ix]-jsci[j_iy[dwsm],j_ix[dwsm]]
+                dwsm=slice(None)
+                if (diff.size >= minpix):
+                    clipped=medclip(diff,median_tol=median_tol,verbose=0)
+                    merr=median_error(diff,i_ix,i_iy,clipped[1],clipped[2])
+                    if (verbose > 2):
+                        print("Sample spacing {:d}: {:d} pixels, median {:.4f} +/- {:.4f} (std {:.4f})".format(stride,diff.size,clipped[1],merr,clipped[2]))
+                    if (merr <= sample*clipped[2]):
+                        break
+                if (stride == 1):
+                    break
+                stride//=2
+                origin=origin%stride
+            # the pixel count reported estimates the full overlap
+            nscale=stride*stride
+            t5=time.time()
+            if (verbose > 2):
+                print("Sampled pixel arrays (spacing {:d}): {:.2f} ".format(stride,t5-t3))
 
     MedPix=diff[dwsm].size
 
     if (MedPix >= minpix):
-        mdiffval=diff[dwsm]
-        AvgDiff,MedDiff,MedStd,MedPix=medclip(mdiffval,verbose=0)
+        if (clipped is None):
+            mdiffval=diff[dwsm]
+            clipped=medclip(mdiffval,median_tol=median_tol,verbose=0)
+        AvgDiff,MedDiff,MedStd,MedPix=clipped
+        MedPix=MedPix*nscale
     if (MedPix >= minpix):
         if (verbose > 0):
             t6=time.time()
@@ -206,37 +668,291 @@ def med_diff(ImgDict,iImg,jImg,minpix=500,verbose=0):
     return MedDiff,MedStd,MedPix
 
 
-################################################
-if __name__ == "__main__":
-    # usage `python3 findoff.py -i "list/sci.g.list" -o "out/test.g.offset_b8" -v 1 --useTAN --fluxscale "list/flx.g.list"`
-    t00=time.time()
-    parser = argparse.ArgumentParser(description='Code to take offset measurement and find optimal set of per image offsets for the ensemble') 
+###########################################
+class PairStore:
+    """
+    Persistent store of pair measurements (medoff, medsig, npix), so a rerun only measures the pairs whose inputs changed.
+    A measurement is keyed by a hash of the content of both images, both WCS (see wcsutil.WCS.get_hash), both fluxscales
+    and the measurement options (minpix and the med_diff options).  The content hash of a file is only recomputed when
+    its size or mtime change.  The store is a single .npz file, replaced atomically by save(); by default save() only
+    keeps the measurements and file hashes used since the store was opened, so the store tracks the current pair list.
+    Args:
+        filename (str): The store file (created by save() if it does not exist).
+        verbose (int): The verbosity level.
+    """
+    # bump when med_diff changes in a way that changes its results
+    version=1
 
-    parser.add_argument('-i','--input',   action='store', type=str, default=None, required=True,  help='Input image list')
-    parser.add_argument('-o','--output',  action='store', type=str, default=None, required=True,  help='Output file of offset measurements')
-    parser.add_argument('--fluxscale',    action='store', type=str, default=None, help='Optional set of fluxscales that need to be applied to data')
-    parser.add_argument('--magzero',      action='store', type=str, default=None, help='Optional set of ZeroPoints to convert to fluxscales and applied to data')
-    parser.add_argument('--magbase',      action='store', type=float, default=30.0, help='MagBase for converting magzero to fluxscale (default=30.0)')
-    parser.add_argument('--useTAN',        action='store_true', default=False, required=False, help='Flag to use tan_nwgint variant of input images')
+    def __init__(self,filename,verbose=0):
+        self.filename=filename
+        self.verbose=verbose
+        self.pairs={}
+        self.files={}
+        self.used=set()
+        self.used_files=set()
+        self.hits=0
+        if (os.path.isfile(filename)):
+            with np.load(filename) as npz:
+                for key,res in zip(npz['pkey'],npz['pres']):
+                    self.pairs[str(key)]=(float(res[0]),float(res[1]),int(res[2]))
+                for fname,st,fhash in zip(npz['fname'],npz['fstat'],npz['fhash']):
+                    self.files[str(fname)]=(int(st[0]),int(st[1]),str(fhash))
+            if (verbose > 0):
+                print("Pair store {:s}: {:d} measurements".format(filename,len(self.pairs)))
 
-    parser.add_argument('-v','--verbose', action='store', type=int, default=0,    required=False, help='Verbosity (default=0, max=2)')
-    parser.add_argument('-b','--boot',    action='store_true', default=False,     required=False, help='Use bootstrap to make an intial guess)')
+    def file_hash(self,filename):
+        """Hash of the content of filename (cached by size and mtime)"""
+        st=os.stat(filename)
+        self.used_files.add(filename)
+        cached=self.files.get(filename)
+        if ((cached is not None)and(cached[0] == st.st_size)and(cached[1] == st.st_mtime_ns)):
+            return cached[2]
+        h=hashlib.sha1()
+        with open(filename,'rb') as f:
+            for block in iter(lambda: f.read(16*1024**2),b''):
+                h.update(block)
+        self.files[filename]=(st.st_size,st.st_mtime_ns,h.hexdigest())
+        return self.files[filename][2]
 
-    args = parser.parse_args()
-    if (args.verbose > 0):
-        print("Args: {:}".format(args))
+    def key(self,ImgDict,iImg,jImg,options):
+        """Key of the measurement of pair (iImg, jImg) with the given options (a dictionary of the measurement options)"""
+        h=hashlib.sha1()
+        h.update("{:d};".format(self.version).encode())
+        for Img in (iImg,jImg):
+            h.update("{:s};{:s};{!r};".format(self.file_hash(os.path.join("data",Img)),ImgDict[Img]['wcs'].get_hash(),float(ImgDict[Img]['fluxscale'])).encode())
+            # only hashed when set, so the keys of measurements without a sidecar stay the same
+            if (ImgDict[Img].get('zoff',0.0) != 0.0):
+                h.update("zoff={!r};".format(float(ImgDict[Img]['zoff'])).encode())
+        h.update(repr(sorted(options.items())).encode())
+        return h.hexdigest()
 
-    # get information from input image list
-    f=open(args.input,'r')
+    def get(self,key):
+        """The stored (medoff, medsig, npix) for key, or None"""
+        res=self.pairs.get(key)
+        self.used.add(key)
+        if (res is not None):
+            self.hits+=1
+        return res
 
-    i=0
+    def put(self,key,res):
+        self.used.add(key)
+        self.pairs[key]=(float(res[0]),float(res[1]),int(res[2]))
+
+    def prune(self):
+        """Drop the measurements and file hashes not used (by get, put or file_hash) since the store was opened"""
+        ndrop=len(self.pairs)-len(self.used & self.pairs.keys())
+        self.pairs={key:res for key,res in self.pairs.items() if (key in self.used)}
+        self.files={fname:st for fname,st in self.files.items() if (fname in self.used_files)}
+        if ((self.verbose > 0)and(ndrop > 0)):
+            print("Pair store {:s}: dropped {:d} unused measurements".format(self.filename,ndrop))
+
+    def save(self,prune=True):
+        """
+        Write the store (atomically, see fileutil.atomic_write).
+        Args:
+            prune (bool): Drop the entries not used in this run first (see prune()), so the store does not grow
+                with every change of the inputs.  Use False to keep them (e.g. when a run only covers part of the pairs).
+        """
+        if (prune):
+            self.prune()
+        pkey=np.array(list(self.pairs.keys()),dtype='U40')
+        pres=np.array(list(self.pairs.values()),dtype=np.float64).reshape(-1,3)
+        fname=np.array(list(self.files.keys()))
+        fstat=np.array([val[:2] for val in self.files.values()],dtype=np.int64).reshape(-1,2)
+        fhash=np.array([val[2] for val in self.files.values()],dtype='U40')
+        with atomic_write(self.filename,suffix=".npz") as tname:
+            np.savez(tname,pkey=pkey,pres=pres,fname=fname,fstat=fstat,fhash=fhash)
+
+
+###########################################
+def find_overlaps(ImgDict,flist,verbose=0):
+    """
+    Find the pairs of images whose footprints overlap.
+    Two images overlap if the differences of their centres in RA and Dec are less than the average of their sizes in RA and Dec.
+    Rather than testing every pair, candidate pairs are found with a KD-tree of the image centres on the unit sphere
+    (searched out to the largest separation that could pass the test), then the RA/Dec test is applied to the candidates only.
+    Using unit vectors and wrapping the RA difference into [-180,180) handles images that cross RA=0 (CROSSRA0).
+    Args:
+        ImgDict (dict): A dictionary containing 'ra_cent', 'dec_cent', 'ra_size', 'dec_size' and 'crossra0' for each image.
+        flist (list): List of image names (the order defines the image numbers).
+        verbose (int): The verbosity level.
+    Returns:
+        tuple: Two arrays (i, j) of image numbers with i < j, sorted by i then j.
+    """
+    nimg=len(flist)
+    ra=np.array([ImgDict[Img]['ra_cent'] for Img in flist],dtype=np.float64)
+    dec=np.array([ImgDict[Img]['dec_cent'] for Img in flist],dtype=np.float64)
+    ra_size=np.array([ImgDict[Img]['ra_size'] for Img in flist],dtype=np.float64)
+    dec_size=np.array([ImgDict[Img]['dec_size'] for Img in flist],dtype=np.float64)
+    if (nimg < 2):
+        return np.zeros(0,dtype=np.int64),np.zeros(0,dtype=np.int64)
+
+    # any overlapping pair is closer on the sky than this (1% margin for the small angle approximation)
+    maxsep=1.01*np.hypot(np.amax(ra_size),np.amax(dec_size))
+    maxsep=min(maxsep,180.0)
+    chord=2.0*np.sin(0.5*np.radians(maxsep))
+
+    rar=np.radians(ra)
+    decr=np.radians(dec)
+    xyz=np.column_stack((np.cos(decr)*np.cos(rar),np.cos(decr)*np.sin(rar),np.sin(decr)))
+    cand=cKDTree(xyz).query_pairs(chord,output_type='ndarray')
+    if (cand.size == 0):
+        return np.zeros(0,dtype=np.int64),np.zeros(0,dtype=np.int64)
+    i=np.minimum(cand[:,0],cand[:,1]).astype(np.int64)
+    j=np.maximum(cand[:,0],cand[:,1]).astype(np.int64)
+
+    # overlap calculation
+    # RA differences are wrapped into [-180,180) so that images on either side of RA=0 compare correctly
+    dra=np.mod(ra[i]-ra[j]+180.0,360.0)-180.0
+    ddec=dec[i]-dec[j]
+    avg_ra_size=0.5*(ra_size[i]+ra_size[j])
+    avg_dec_size=0.5*(dec_size[i]+dec_size[j])
+    # Images overlap if the absolute differences in RA and Dec are less than the average sizes
+    over=np.logical_and(np.abs(dra) < avg_ra_size,np.abs(ddec) < avg_dec_size)
+
+    # verbose output
+    if (verbose > 3):
+        for k in range(i.size):
+            iImg=flist[i[k]]
+            jImg=flist[j[k]]
+            if ((ImgDict[iImg]['crossra0'] == "Y")or(ImgDict[jImg]['crossra0'] == "Y")):
+                print("Either {:s} or {:s} or both have CROSSRA0 == Y".format(iImg,jImg))
+            print("dr={:12.7f} dd={:12.7f} rs={:12.7f} ds={:12.7f} ".format(dra[k],ddec[k],avg_ra_size[k],avg_dec_size[k]))
+            print("{:9s}: {:s} with {:s}".format("  Overlap" if over[k] else "NoOverlap",iImg,jImg))
+
+    i=i[over]
+    j=j[over]
+    order=np.lexsort((j,i))
+    return i[order],j[order]
+
+
+###########################################
+def chunk_pairs(pairs,nchunk):
+    """
+    Split the (ordered) list of image pairs into at most nchunk contiguous chunks for the worker pool.
+    Chunk boundaries are placed where the first image of the pair changes whenever possible,
+    so all pairs that share an iImg (and most of their neighbours) are measured by the same worker
+    and its image cache gets reused.
+    Args:
+        pairs (list): List of (iImg, jImg) tuples ordered by iImg.
+        nchunk (int): Target number of chunks.
+    Returns:
+        list: List of chunks, each a list of (index, iImg, jImg) tuples where index is the position in pairs.
+    """
+    target=max(1,int(np.ceil(len(pairs)/max(1,nchunk))))
+    chunks=[]
+    chunk=[]
+    for k,(iImg,jImg) in enumerate(pairs):
+        if ((len(chunk) >= target)and(iImg != chunk[-1][1])):
+            chunks.append(chunk)
+            chunk=[]
+        chunk.append((k,iImg,jImg))
+    if (len(chunk) > 0):
+        chunks.append(chunk)
+    return chunks
+
+
+_worker={}
+def _init_worker(ImgDict,minpix,maxbytes,mdopts,verbose):
+    """Set up the per-process state used by _measure_chunk"""
+    _worker['ImgDict']=ImgDict
+    _worker['minpix']=minpix
+    _worker['cache']=ImageCache(maxbytes=maxbytes)
+    _worker['mdopts']=mdopts
+    _worker['verbose']=verbose
+
+
+def _measure_chunk(chunk):
+    """Measure every pair in a chunk, returns a list of (index, (medoff, medsig, npix))"""
+    results=[]
+    for k,iImg,jImg in chunk:
+        res=med_diff(_worker['ImgDict'],iImg,jImg,minpix=_worker['minpix'],cache=_worker['cache'],verbose=_worker['verbose'],**_worker['mdopts'])
+        results.append((k,res))
+    return results
+
+
+###########################################
+def measure_pairs(ImgDict,pairs,minpix=500,maxbytes=2048*1024**2,workers=1,mdopts=None,store=None,verbose=0):
+    """
+    Run med_diff on a list of image pairs, optionally spread over a pool of worker processes.
+    With a store (PairStore) only the pairs without a stored measurement are run, and their results are added to the store (and saved).
+    Args:
+        ImgDict (dict): A dictionary containing the image metadata (needs 'wcs' and 'fluxscale' for each image).
+        pairs (list): List of (iImg, jImg) tuples.
+        minpix (int): The minimum number of pixels required for the calculation.
+        maxbytes (int): Memory budget of the image cache of each process.
+        workers (int): Number of worker processes (1 = run serially in this process).
+        mdopts (dict): Optional extra keyword arguments for med_diff.
+        store (PairStore): Optional store of earlier measurements.
+        verbose (int): The verbosity level.
+    Returns:
+        list: (medoff, medsig, npix) for each pair, in the same order as pairs.
+    """
+    if (mdopts is None):
+        mdopts={}
+    if (store is not None):
+        # the options that change the measurement (the pixel map cache does not)
+        options={key:val for key,val in mdopts.items() if (key != 'mapcache')}
+        options['minpix']=minpix
+        keys=[store.key(ImgDict,iImg,jImg,options) for iImg,jImg in pairs]
+        results=[store.get(key) for key in keys]
+        todo=[k for k,res in enumerate(results) if (res is None)]
+        if (verbose > 0):
+            print("Pair store: {:d} pairs stored, {:d} to measure".format(len(pairs)-len(todo),len(todo)))
+        if (len(todo) > 0):
+            new=measure_pairs(ImgDict,[pairs[k] for k in todo],minpix=minpix,maxbytes=maxbytes,workers=workers,mdopts=mdopts,verbose=verbose)
+            for k,res in zip(todo,new):
+                results[k]=res
+                store.put(keys[k],res)
+        store.save()
+        return results
+
+    results=[None]*len(pairs)
+    if (workers <= 1):
+        cache=ImageCache(maxbytes=maxbytes)
+        for k,(iImg,jImg) in enumerate(pairs):
+            if (verbose > 1):
+                print(iImg,jImg)
+            results[k]=med_diff(ImgDict,iImg,jImg,minpix=minpix,cache=cache,verbose=verbose,**mdopts)
+        if (verbose > 0):
+            print("Image cache: {:d} reads, {:d} reuses".format(cache.misses,cache.hits))
+        return results
+
+    # only send what the workers need (WCS, fluxscale, image number and sidecar offset), not the headers
+    wdict={}
+    for Img in ImgDict:
+        wdict[Img]={key:ImgDict[Img][key] for key in ('wcs','fluxscale','inum','zoff') if (key in ImgDict[Img])}
+
+    # several chunks per worker to balance the load
+    chunks=chunk_pairs(pairs,4*workers)
+    if (verbose > 0):
+        print("Measuring {:d} pairs in {:d} chunks with {:d} workers".format(len(pairs),len(chunks),workers))
+    with multiprocessing.Pool(workers,initializer=_init_worker,initargs=(wdict,minpix,maxbytes,mdopts,verbose)) as pool:
+        for chunk_results in pool.imap_unordered(_measure_chunk,chunks):
+            for k,res in chunk_results:
+                results[k]=res
+    return results
+
+
+################################################
+def read_image_list(filename,useTAN=False):
+    """
+    Read an image list (one image per line, e.g. data/list/sci.i.list).
+    Args:
+        filename (str): The image list.
+        useTAN (bool): Use the tan_nwgint variant of the images (the list names the coadd_nwgint images).
+    Returns:
+        tuple: (flist, fdict) with the image names in list order and a dictionary with the image number ('inum') and listed name ('fname0') of each image.
+    """
     flist=[]  # list of image names
     fdict={}  # dictionary of image names, id, fluxscales, and WCS
-    # read image list
+    f=open(filename,'r')
+    i=0
     for line in f:
         cols=line.split()
         fname0=re.sub(r"\[0\]","",cols[0])
-        if (args.useTAN):
+        fname=fname0
+        if (useTAN):
             fname=re.sub("coadd_nwgint","tan_nwgint",fname0)  # just to match the filenames in tan_nwgint directory correctly
             fname=re.sub("_nwgint.fits","_nwgint_tan.fits",fname)
         flist.append(fname)
@@ -244,28 +960,36 @@ if __name__ == "__main__":
         fdict[fname]['inum']=i
         fdict[fname]['fname0']=fname0
         i=i+1
-    print("Found {:d} image files".format(len(flist)))
     f.close()
+    return flist,fdict
 
-    # read fluxscale info
-    if ((args.fluxscale is None)and(args.magzero is None)):
-        if (args.verbose > 0): 
+
+###########################################
+def read_fluxscales(fdict,fluxscale=None,magzero=None,magbase=30.0,useTAN=False,verbose=0):
+    """
+    Add the fluxscale of each image to fdict (from a fluxscale list, or from a list of zeropoints), or 1.0 if neither is given.
+    Args:
+        fdict (dict): Image dictionary from read_image_list.
+        fluxscale (str): Optional fluxscale list (image name and fluxscale per line).
+        magzero (str): Optional zeropoint list (image name and zeropoint per line), converted with magbase.
+        magbase (float): MagBase for converting magzero to fluxscale.
+        useTAN (bool): Match the names to the tan_nwgint variant of the images.
+        verbose (int): The verbosity level.
+    """
+    if ((fluxscale is None)and(magzero is None)):
+        if (verbose > 0): 
             print("No --fluxscale or --magzero.  Assuming all fluxscales are 1.0")
         for fname in fdict:
             fdict[fname]['fluxscale']=1.0
     else:
-        if (args.fluxscale is not None):
-#            print("RAG: Going the fluxscale route")
-            if (os.path.isfile(args.fluxscale)):
-                f_flux=open(args.fluxscale,'r')
+        if (fluxscale is not None):
+            if (os.path.isfile(fluxscale)):
+                f_flux=open(fluxscale,'r')
                 useFluxScale=True
-        elif (args.magzero is not None):
-#            print("RAG: Going the magzero route")
-            if (os.path.isfile(args.magzero)):
-                f_flux=open(args.magzero,'r')
+        elif (magzero is not None):
+            if (os.path.isfile(magzero)):
+                f_flux=open(magzero,'r')
                 useFluxScale=False
-        else:
-            print("No fluxscale or magzero?  This line should never be able to execute")
 
         i2=0
         for line in f_flux:
@@ -274,8 +998,8 @@ if __name__ == "__main__":
             if (useFluxScale):
                 fscale=float(cols[1])
             else:
-                fscale=10.**(0.4*(args.magbase-float(cols[1])))
-            if (args.useTAN):
+                fscale=10.**(0.4*(magbase-float(cols[1])))
+            if (useTAN):
                 fname=re.sub("coadd_nwgint","tan_nwgint",fname)  # just to match the filenames correctly
                 fname=re.sub("_nwgint.fits","_nwgint_tan.fits",fname)
             if (fname in fdict):
@@ -295,119 +1019,274 @@ if __name__ == "__main__":
             i3=i3+1
     print("Found {:d} fluxscale entries in fdict".format(i3))
 
-###############################
 
-    # FITSIO and WCS on images
+###########################################
+# columns of the header catalog (besides the file name, mtime and size)
+_catalog_cols=[('crossra0','U1'),('ra_cent','f8'),('dec_cent','f8'),
+               ('racmin','f8'),('racmax','f8'),('deccmin','f8'),('deccmax','f8')]
+
+
+###########################################
+def _catalog_row(filename):
+    """Header metadata of one image for the catalog: stat info, footprint keywords and the WCS keywords (as JSON)
+    """
+    st=os.stat(filename)
+    ih=get_header(filename)
+    wcs=wcsutil.header_dict(ih)
+    wcs={key:val for key,val in wcs.items() if wcsutil._hash_keys.match(key)}
+    row=[filename,st.st_mtime,st.st_size]
+    for col,_ in _catalog_cols:
+        row.append(ih[col.upper()])
+    row.append(json.dumps(wcs,sort_keys=True))
+    return tuple(row)
+
+
+###########################################
+def header_catalog(files,catfile=None,workers=1,verbose=0):
+    """
+    Catalog of the header metadata (footprint keywords and WCS keywords) of a set of images, read from the SCI headers only.
+    With catfile the catalog is kept as a structured array in an .npz file: rows of files whose mtime and size are unchanged
+    are reused and only new or modified files have their headers read (in parallel with workers > 1).
+    Args:
+        files (list): Image file names.
+        catfile (str): Optional catalog file to read and update.
+        workers (int): Number of processes used to read headers.
+        verbose (int): The verbosity level.
+    Returns:
+        dict: Catalog row (numpy.void with fields fname, mtime, size, crossra0, ra_cent, ..., deccmax, wcs) for each file found.
+    """
+    old={}
+    if ((catfile is not None)and(os.path.isfile(catfile))):
+        with np.load(catfile) as npz:
+            for row in npz['cat']:
+                old[str(row['fname'])]=row
+
+    rows={}
+    todo=[]
+    for fname in files:
+        if (not(os.path.isfile(fname))):
+            continue
+        if (fname in old):
+            st=os.stat(fname)
+            if ((old[fname]['mtime'] == st.st_mtime)and(old[fname]['size'] == st.st_size)):
+                rows[fname]=old[fname]
+                continue
+        todo.append(fname)
+    if (verbose > 0):
+        print("Header catalog: {:d} cached, {:d} to read".format(len(rows),len(todo)))
+    if (len(todo) == 0):
+        return rows
+
+    if ((workers > 1)and(len(todo) > 1)):
+        with multiprocessing.Pool(min(workers,len(todo))) as pool:
+            new=pool.map(_catalog_row,todo,chunksize=max(1,len(todo)//(4*workers)))
+    else:
+        new=[_catalog_row(fname) for fname in todo]
+
+    # keep the rows of files that were not asked for (e.g. other bands)
+    keep=[tuple(row) for fname,row in old.items() if ((fname not in rows)and(fname not in todo))]
+    allrows=[tuple(row) for row in rows.values()]+new+keep
+    dtype=[('fname','U{:d}'.format(max(len(r[0]) for r in allrows))),('mtime','f8'),('size','i8')]+_catalog_cols+\
+          [('wcs','U{:d}'.format(max(len(r[-1]) for r in allrows)))]
+    cat=np.array(allrows,dtype=dtype)
+    if (catfile is not None):
+        with atomic_write(catfile,suffix=".npz") as tname:
+            np.savez(tname,cat=cat)
+    return {str(row['fname']):row for row in cat[:len(rows)+len(new)]}
+
+
+###########################################
+def read_wcs(fdict,flist,wcscache=None,catalog=None):
+    """
+    Read the SCI header of each image (under data/) and add its footprint (centre and size) and its WCS to fdict.
+    With wcscache (wcsutil.WCSCache) the WCS are loaded from / stored in the on-disk cache.
+    With catalog (from header_catalog, keyed by data/<image>) the metadata are taken from the catalog instead of the headers.
+    Returns:
+        bool: True if all the images were found.
+    """
     file_missing=False
-    ts0=time.time()
     for Img in flist:
-        if (os.path.isfile(os.path.join("data",Img))):
-            ih,isci,imsk,iwgt=get_data(os.path.join("data",Img))
-            fdict[Img]['header']=ih
-            fdict[Img]['crossra0']=ih['CROSSRA0']
-            fdict[Img]['ra_cent']=ih['RA_CENT']
-            fdict[Img]['dec_cent']=ih['DEC_CENT']
-            if (ih['CROSSRA0'] == "Y"):
-                fdict[Img]['ra_size']=(360.0-ih['RACMAX'])+ih['RACMIN']
-                fdict[Img]['dec_size']=ih['DECCMAX']-ih['DECCMIN']
-            else:
-                fdict[Img]['ra_size']=ih['RACMAX']-ih['RACMIN']
-                fdict[Img]['dec_size']=ih['DECCMAX']-ih['DECCMIN']
-            fdict[Img]['wcs']=wcsutil.WCS(ih)
-            #print("Read WCS for {:s} will be using a fluxscale of {:.5f} ".format(Img,fdict[Img]['fluxscale']))
-        else:
+        fname=os.path.join("data",Img)
+        if (not(os.path.isfile(fname))):
             print("File: {:s} not found.".format(Img))
             file_missing=True
-    if (file_missing):
-        print("Missing file(s).  Aborting!")
-        exit(1)
-    ts1=time.time()
-    print("Timing (acquire WCS): {:.2f}".format(ts1-ts0))
+            continue
+        if (catalog is None):
+            ih=get_header(fname)
+            meta={col:ih[col.upper()] for col,_ in _catalog_cols}
+            wcs=ih
+        else:
+            row=catalog[fname]
+            meta={col:row[col].item() for col,_ in _catalog_cols}
+            wcs=json.loads(str(row['wcs']))
+        fdict[Img]['crossra0']=meta['crossra0']
+        fdict[Img]['ra_cent']=meta['ra_cent']
+        fdict[Img]['dec_cent']=meta['dec_cent']
+        if (meta['crossra0'] == "Y"):
+            fdict[Img]['ra_size']=(360.0-meta['racmax'])+meta['racmin']
+            fdict[Img]['dec_size']=meta['deccmax']-meta['deccmin']
+        else:
+            fdict[Img]['ra_size']=meta['racmax']-meta['racmin']
+            fdict[Img]['dec_size']=meta['deccmax']-meta['deccmin']
+        if (wcscache is None):
+            fdict[Img]['wcs']=wcsutil.WCS(wcs)
+        else:
+            fdict[Img]['wcs']=wcscache.get(wcs)
+        #print("Read WCS for {:s} will be using a fluxscale of {:.5f} ".format(Img,fdict[Img]['fluxscale']))
+    return not(file_missing)
+
 
-    # identify which image pairs have overlapping regions
+###########################################
+def pair_list(flist,ipair,jpair):
+    """
+    Turn the pair indices from find_overlaps into (iImg, jImg) name pairs and their running count
+    (position of the pair among all i < j pairs, as written to the offset file).
+    """
     nimg=len(flist)
-    imatch=np.zeros((nimg,nimg),dtype='int16')  # store information about whether pairs of images overlap (1 = overlap, 0 = no overlap)
- 
-    for iImg in flist:
-        for jImg in flist:
-            if (iImg == jImg):
-                imatch[fdict[iImg]['inum'],fdict[jImg]['inum']]=0
-            else:
-                # checks if either image has a CROSSRA0 flag set to "Y". 
-                # This flag indicates that the image crosses the 0 or 360-degree line in Right Ascension (RA), which is a special case for overlap calculation.
-                # The code adjusts RA values accordingly to handle this case.
-                if ((fdict[iImg]['crossra0'] == "Y")or(fdict[jImg]['crossra0'] == "Y")):
-                    print("Either {:s} or {:s} or both have CROSSRA0 == Y".format(iImg,jImg))
-                    ra1=fdict[iImg]['ra_cent']
-                    ra2=fdict[jImg]['ra_cent']
-                    if (ra1 > 180.):
-                        ra1=ra1-360.0
-                    if (ra2 > 180.):
-                        ra2=ra2-360.0
-                    dra=ra1-ra2
-                    printf("Checking that CROSSRA0 case is working")
-                    printf("  {:12.7f} --> {:12.7f} for {:s} ".format(fdict[iImg]['ra_cent'],ra1,iImg))
-                    printf("  {:12.7f} --> {:12.7f} for {:s} ".format(fdict[jImg]['ra_cent'],ra2,jImg))
-                    printf("  {:12.7f}  ".format(dra))
-                else:
-                    dra=fdict[iImg]['ra_cent']-fdict[jImg]['ra_cent']
-                # overlap calculation
-                # calculate the difference in RA and Declination (Dec) centers between the two images (dra and ddec) and compute the average sizes in RA and Dec for the images (ra_size and dec_size).
-                ddec=fdict[iImg]['dec_cent']-fdict[jImg]['dec_cent']
-                ra_size=0.5*(fdict[iImg]['ra_size']+fdict[jImg]['ra_size'])
-                dec_size=0.5*(fdict[iImg]['dec_size']+fdict[jImg]['dec_size'])
-                if (args.verbose > 3):
-                    print("dr={:12.7f} dd={:12.7f} rs={:12.7f} ds={:12.7f} ".format(dra,ddec,ra_size,dec_size))                    
-                OverLap=False
-                OverLapStr="NoOverlap"
-                # Images overlap if the absolute differences in RA and Dec are less than the average sizes
-                if ((abs(dra) < ra_size)and(abs(ddec) < dec_size)):
-                    OverLap=True
-                    OverLapStr="  Overlap"
-                    imatch[fdict[iImg]['inum'],fdict[jImg]['inum']]=1
-                # verbose output
-                if (args.verbose > 3):
-                    print("{ovstr:9s}: {r1:12.7f} {r2:12.7f} {d1:12.7f} {d2:12.7f} ".format(
-                        ovstr=OverLapStr,
-                        r1=fdict[iImg]['header']['RACMIN'],
-                        r2=fdict[iImg]['header']['RACMAX'],
-                        d1=fdict[iImg]['header']['DECCMIN'],
-                        d2=fdict[iImg]['header']['DECCMAX']))
-                    print("     with: {r1:12.7f} {r2:12.7f} {d1:12.7f} {d2:12.7f} ".format(
-                        r1=fdict[jImg]['header']['RACMIN'],
-                        r2=fdict[jImg]['header']['RACMAX'],
-                        d1=fdict[jImg]['header']['DECCMIN'],
-                        d2=fdict[jImg]['header']['DECCMAX']))
-
-    #print(imatch)
-    
-    fout=open(args.output,'w')
+    pairs=[(flist[i],flist[j]) for i,j in zip(ipair,jpair)]
+    pcount=ipair*nimg-(ipair*(ipair+1))//2+(jpair-ipair)
+    return pairs,pcount
+
+
+###########################################
+def write_offsets(filename,fdict,flist,pairs,pcount,results,minpix=500,fmt='text'):
+    """
+    Write the offset measurements (the input of fitoff): the image list, then one line per pair with at least minpix pixels.
+    With fmt='npz' the same content is written in binary columns instead (see write_offsets_npz).
+    """
+    if (fmt == 'npz'):
+        write_offsets_npz(filename,fdict,flist,pairs,pcount,results,minpix=minpix)
+        return
+    fout=open(filename,'w')
     for iImg in flist:
         fout.write(" {inum:6d} {fname:s} \n".format(
             inum=fdict[iImg]['inum']+1,
             fname=fdict[iImg]['fname0']))
     fout.write("END OF FILELIST\n")
-
-    # loop over all image pairs and write output to file
-    count=1
-    for iImg in flist:
-        for jImg in flist:
-            if (fdict[jImg]['inum'] > fdict[iImg]['inum']):
-                if (imatch[fdict[iImg]['inum'],fdict[jImg]['inum']] == 1):
-                    if (args.verbose > 1):
-                        print(iImg,jImg)
-                    medoff,medsig,npix=med_diff(fdict,iImg,jImg,minpix=500,verbose=args.verbose)
-                    if (npix >= 500):
-                        fout.write(" {offval:11.3f} {cval:11.3f} {inum:6d} {jnum:6d} {pixval:10d} {offsig:12.4f} \n".format(
-                            offval=medoff,
-                            cval=count,
-                            inum=fdict[iImg]['inum']+1,
-                            jnum=fdict[jImg]['inum']+1,
-                            pixval=npix,
-                            offsig=medsig))
-                count=count+1
+    for (iImg,jImg),count,(medoff,medsig,npix) in zip(pairs,pcount,results):
+        if (npix >= minpix):
+            fout.write(" {offval:11.3f} {cval:11.3f} {inum:6d} {jnum:6d} {pixval:10d} {offsig:12.4f} \n".format(
+                offval=medoff,
+                cval=count,
+                inum=fdict[iImg]['inum']+1,
+                jnum=fdict[jImg]['inum']+1,
+                pixval=npix,
+                offsig=medsig))
     fout.close()    
 
+
+###########################################
+def write_offsets_npz(filename,fdict,flist,pairs,pcount,results,minpix=500):
+    """
+    Write the offset measurements as an npz with one full precision column per quantity (read by fitoff.read_offsets).
+    The image table has the image numbers (inum, from 1) and names (fname), the pair columns are the image numbers (inum, jnum),
+    the median offset (offset), the pair count (pnum), the number of pixels (npix) and the std (sigma) of each pair with at least minpix pixels.
+    """
+    good=[k for k,res in enumerate(results) if (res[2] >= minpix)]
+    inum=np.array([fdict[Img]['inum']+1 for Img in flist],dtype=np.int32)
+    fname=np.array([fdict[Img]['fname0'] for Img in flist])
+    cols={
+        'inum':np.array([fdict[pairs[k][0]]['inum']+1 for k in good],dtype=np.int32),
+        'jnum':np.array([fdict[pairs[k][1]]['inum']+1 for k in good],dtype=np.int32),
+        'offset':np.array([results[k][0] for k in good],dtype=np.float64),
+        'pnum':np.array([pcount[k] for k in good],dtype=np.float64),
+        'npix':np.array([results[k][2] for k in good],dtype=np.int32),
+        'sigma':np.array([results[k][1] for k in good],dtype=np.float64)}
+    with atomic_write(filename,suffix=".npz") as tname:
+        np.savez(tname,version=np.array(1),image_inum=inum,image_fname=fname,**cols)
+
+
+###########################################
+if __name__ == "__main__":
+    # usage `python3 findoff.py -i "list/sci.g.list" -o "out/test.g.offset_b8" -v 1 --useTAN --fluxscale "list/flx.g.list"`
+    t00=time.time()
+    parser = argparse.ArgumentParser(description='Code to take offset measurement and find optimal set of per image offsets for the ensemble') 
+
+    parser.add_argument('-i','--input',   action='store', type=str, default=None, required=True,  help='Input image list')
+    parser.add_argument('-o','--output',  action='store', type=str, default=None, required=True,  help='Output file of offset measurements')
+    parser.add_argument('--format',       action='store', type=str, default='auto', choices=['auto','text','npz'], help='Format of the output file (text=findoff text file, npz=binary full precision columns, default=auto: npz if the output ends with .npz)')
+    parser.add_argument('--fluxscale',    action='store', type=str, default=None, help='Optional set of fluxscales that need to be applied to data')
+    parser.add_argument('--magzero',      action='store', type=str, default=None, help='Optional set of ZeroPoints to convert to fluxscales and applied to data')
+    parser.add_argument('--magbase',      action='store', type=float, default=30.0, help='MagBase for converting magzero to fluxscale (default=30.0)')
+    parser.add_argument('--useTAN',        action='store_true', default=False, required=False, help='Flag to use tan_nwgint variant of input images')
+    parser.add_argument('--cache_mb',     action='store', type=float, default=2048.0, help='Memory budget (MB) for caching image data between pairs (default=2048, per worker)')
+    parser.add_argument('--workers',      action='store', type=int, default=1, help='Number of processes used to measure pairs (default=1)')
+    parser.add_argument('--mapcache',     action='store', type=str, default=None, help='Optional directory to cache pixel mappings between image pairs (reused across runs and bands)')
+    parser.add_argument('--pairstore',    action='store', type=str, default=None, help='Optional store (.npz) of pair measurements; only pairs whose images, WCS, fluxscales or options changed are measured')
+    parser.add_argument('--catalog',      action='store', type=str, default=None, help='Optional header catalog (.npz) of the image metadata, created or updated as needed')
+    parser.add_argument('--wcscache',     action='store', type=str, default=None, help='Optional directory to cache the WCS of each image (keyed by header hash)')
+    parser.add_argument('--gridmap',      action='store', type=int, default=None, help='Optional grid spacing (pixels) for an interpolated pixel mapping instead of the exact per-pixel transform (e.g. 64)')
+    parser.add_argument('--gridtol',      action='store', type=float, default=0.01, help='Maximum error (pixels) of the interpolated mapping with --gridmap (default=0.01)')
+    parser.add_argument('--rowblock',     action='store', type=int, default=None, help='Optional number of rows per block to stream each overlap with bounded memory instead of holding whole images (e.g. 512)')
+    parser.add_argument('--sample',       action='store', type=float, default=None, help='Optional subsampling of overlap pixels until the error of the median is below SAMPLE times its std (e.g. 0.1; not with --rowblock or --mapcache)')
+    parser.add_argument('--seed',         action='store', type=int, default=0, help='Random seed for the --sample lattice (default=0)')
+    parser.add_argument('--sidecar',      action='store', type=str, default=None, help='Optional sidecar of offsets (from zoff_apply --mode sidecar) added (in the units of the measured offsets) to the SCI data as it is read, e.g. to measure the residual offsets')
+    parser.add_argument('--median_tol',   action='store', type=float, default=None, help='Optional error bound for a faster histogram median when clipping more than 10^6 pixels (default=exact median)')
+
+    parser.add_argument('-v','--verbose', action='store', type=int, default=0,    required=False, help='Verbosity (default=0, max=2)')
+    parser.add_argument('-b','--boot',    action='store_true', default=False,     required=False, help='Use bootstrap to make an intial guess)')
+
+    args = parser.parse_args()
+    if (args.verbose > 0):
+        print("Args: {:}".format(args))
+    if ((args.sample is not None)and((args.rowblock is not None)or(args.mapcache is not None))):
+        print("--sample only works on the in-memory path, not with --rowblock or --mapcache.  Aborting!")
+        exit(1)
+
+    # get information from input image list
+    flist,fdict=read_image_list(args.input,useTAN=args.useTAN)
+    print("Found {:d} image files".format(len(flist)))
+
+    # read fluxscale info
+    read_fluxscales(fdict,fluxscale=args.fluxscale,magzero=args.magzero,magbase=args.magbase,useTAN=args.useTAN,verbose=args.verbose)
+
+    # offsets from a sidecar (keyed by the listed image name) are applied whenever SCI is read, converted
+    # back from the coadd_nwgint pixel units of the sidecar to the units of the measured (and fitted) offsets
+    if (args.sidecar is not None):
+        offsets=zoff_apply.read_sidecar(args.sidecar)
+        nzoff=0
+        for Img in flist:
+            if (fdict[Img]['fname0'] in offsets):
+                fdict[Img]['zoff']=offsets[fdict[Img]['fname0']]*zoff_apply.OFFSET_SCALE
+                nzoff+=1
+        print("Found {:d} of {:d} images in sidecar {:s}".format(nzoff,len(flist),args.sidecar))
+
+###############################
+
+    # FITSIO and WCS on images
+    ts0=time.time()
+    wcscache=None
+    if (args.wcscache is not None):
+        wcscache=wcsutil.WCSCache(args.wcscache)
+    catalog=None
+    if (args.catalog is not None):
+        catalog=header_catalog([os.path.join("data",Img) for Img in flist],catfile=args.catalog,workers=args.workers,verbose=args.verbose)
+    if (not(read_wcs(fdict,flist,wcscache=wcscache,catalog=catalog))):
+        print("Missing file(s).  Aborting!")
+        exit(1)
+    ts1=time.time()
+    print("Timing (acquire WCS): {:.2f}".format(ts1-ts0))
+
+    # identify which image pairs have overlapping regions (as an edge list with i < j)
+    ipair,jpair=find_overlaps(fdict,flist,verbose=args.verbose)
+    print("Found {:d} overlapping image pairs".format(ipair.size))
+
+    # collect all overlapping image pairs and their running count (position of the pair among all i < j pairs)
+    pairs,pcount=pair_list(flist,ipair,jpair)
+
+    # measure the pairs and write output to file (in pair order regardless of --workers)
+    mdopts={'median_tol':args.median_tol,'gridstep':args.gridmap,'gridtol':args.gridtol,'rowblock':args.rowblock,'sample':args.sample,'seed':args.seed}
+    if (args.mapcache is not None):
+        mdopts['mapcache']=PixelMapCache(args.mapcache,verbose=args.verbose)
+    store=None
+    if (args.pairstore is not None):
+        store=PairStore(args.pairstore,verbose=args.verbose)
+    results=measure_pairs(fdict,pairs,minpix=500,maxbytes=int(args.cache_mb*1024**2),workers=args.workers,mdopts=mdopts,store=store,verbose=args.verbose)
+    fmt=args.format
+    if (fmt == 'auto'):
+        fmt='npz' if (args.output.endswith(".npz")) else 'text'
+    write_offsets(args.output,fdict,flist,pairs,pcount,results,fmt=fmt)
+
     print("Total execution time: {:.2f} seconds".format(time.time()-t00))
 
     # Process completed
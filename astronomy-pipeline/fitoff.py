@@ -7,10 +7,17 @@ import os
 import argparse
 import re
 import time
+import zipfile
+import multiprocessing
 import fitsio
 import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+from scipy.sparse.csgraph import connected_components,minimum_spanning_tree,breadth_first_order
 from scipy.optimize import curve_fit
 
+# one row per pair measurement (COO like), so memory scales with the number of pairs and not nfile x nfile
+PAIR_DTYPE=np.dtype([('i',np.int32),('j',np.int32),('offset',np.float64),('npix',np.int32),('sigma',np.float64),('pnum',np.float64)])
 
 
 ################################################
@@ -19,82 +26,820 @@ def getoff(x,*p):
     Get the offset between a pair of images.
     The difference p[xjfl[i]] - p[xifl[i]] represents the offset between a pair of images. The calculation is performed for each pair as determined by the indices in xjfl and xifl
     """
-    y=np.array([p[xjfl[i]]-p[xifl[i]] for i in range(x.size)])
+    p=np.asarray(p)
+    y=p[xjfl]-p[xifl]
     return y
 
 
 ################################################
-if __name__ == "__main__":
-    # usage `python3 fitoff.py -i "out/test.g.offset_b8" -o "out/test.g.zoff_b8" -b -v 2`
-    parser = argparse.ArgumentParser(description='Code to take offset measurement and find optimal set of per image offsets for the ensemble') 
+def incidence_matrix(xifl,xjfl,nfile,sval=None):
+    """
+    Build the sparse (npair x nfile) design matrix of the linear model y = p[xjfl] - p[xifl].
+    Each row has a -1 in column xifl and a +1 in column xjfl, divided by sval when sval is given.
+    """
+    npair=xifl.size
+    if (sval is None):
+        wt=np.ones(npair,dtype=np.float64)
+    else:
+        wt=1.0/np.asarray(sval,dtype=np.float64)
+    rows=np.concatenate((np.arange(npair),np.arange(npair)))
+    cols=np.concatenate((xifl,xjfl))
+    vals=np.concatenate((-wt,wt))
+    return scipy.sparse.csr_matrix((vals,(rows,cols)),shape=(npair,nfile))
 
-    parser.add_argument('-i','--input',   action='store', type=str, default=None, required=True,  help='Input offset (pair) measurements from findoff_WCS.')
-    parser.add_argument('-o','--output',  action='store', type=str, default=None, required=True,  help='Output file of optimal (per image) offsets (a zcom file).')
-    parser.add_argument('-e','--exclude', action='store', type=str, default=None, required=False, help='Exclude file (list of images numbers to exclude)')
-    parser.add_argument('-d','--diag',    action='store', type=str, default=None, required=False, help='Diagnostic file (optional output).')
-    parser.add_argument('-w','--weight',  action='store', type=int, default=0,    required=False, help='Weighting mode (0=equal weightdefault), 1=overlap (1/sqrt(#pix)), 2=sigma (1/RMS(offset)))')
-    parser.add_argument('-v','--verbose', action='store', type=int, default=0,    required=False, help='Verbosity (default=0, max=2)')
-    parser.add_argument('-b','--boot',    action='store_true', default=False,     required=False, help='Use bootstrap to make an intial guess)')
 
-    args = parser.parse_args()
-    if (args.verbose > 0):
-        print("Args: {:}".format(args))
+################################################
+def pair_components(xifl,xjfl,nfile):
+    """
+    Find the connected groups of images of the pair graph.
+    Returns:
+        tuple: The number of groups and the group label (0 .. ncomp-1) of each image.
+    """
+    adj=scipy.sparse.csr_matrix((np.ones(xifl.size),(xifl,xjfl)),shape=(nfile,nfile))
+    return connected_components(adj,directed=False)
 
-    f=open(args.input,'r')
 
-    #  Initializations
-    # diff matrix stores the median offset value between pairs of images. For each pair of images identified by their indices (ifile and jfile), it records the median offset (cols[0]) in the corresponding cell.
-    # The nover matrix keeps track of the number of overlapping pixels between each pair of images.
-    # sigma matrix stores the standard deviation of the offsets between each pair of images.
-    # The ldiff matrix is a boolean matrix indicating whether there is a recorded difference (i.e., an offset) between each pair of images.
+################################################
+def gauge_matrix(xifl,xjfl,nfile):
+    """
+    Build the (ncomp x nfile) constraint matrix that fixes the free constant of each connected group of images
+    (sum of the offsets in each group = 0).  The model only constrains differences, so without this the normal equations are singular.
+    """
+    ncomp,labels=pair_components(xifl,xjfl,nfile)
+    return scipy.sparse.csr_matrix((np.ones(nfile),(labels,np.arange(nfile))),shape=(ncomp,nfile))
+
+
+################################################
+def median_zero(p,labels):
+    """
+    Offset each connected group of images (labels from pair_components) so its median offset is 0.
+    """
+    p=np.array(p,dtype=np.float64)
+    order=np.argsort(labels,kind='stable')
+    bounds=np.flatnonzero(np.diff(labels[order]))+1
+    for idx in np.split(order,bounds):
+        p[idx]-=np.median(p[idx])
+    return p
+
+
+################################################
+def solve_sparse(xifl,xjfl,y,nfile,sval=None,errors=False,block=256,emethod='exact',nprobe=64,seed=0):
+    """
+    Solve the linear offset model y = p[xjfl] - p[xifl] with sparse linear algebra.
+    The normal equations (A^T W A) p = A^T W y are solved together with a zero-sum gauge constraint per
+    connected group of images through a sparse LU factorization of the bordered (KKT) system.
+    Args:
+        xifl, xjfl (numpy.ndarray): Image indices of each pair measurement.
+        y (numpy.ndarray): Measured offsets.
+        nfile (int): Number of images.
+        sval (numpy.ndarray): Optional uncertainty of each measurement (None = equal weights).
+        errors (bool): Also compute the per-image errors (diagonal of the constrained covariance, see covariance_diagonal).
+        block (int): Number of probes (or unit vectors) solved at a time when computing the errors.
+        emethod (str): How the errors are computed ('exact' or 'hutchinson', see covariance_diagonal).
+        nprobe (int): Number of probes for emethod='hutchinson'.
+        seed (int): Random seed of the probes.
+    Returns:
+        tuple: Offsets (zero mean in each connected group) and per-image errors (None unless errors=True).
+    """
+    a=incidence_matrix(xifl,xjfl,nfile,sval=sval)
+    if (sval is None):
+        rhs=a.T @ y
+    else:
+        rhs=a.T @ (y/sval)
+    c=gauge_matrix(xifl,xjfl,nfile)
+    ncomp=c.shape[0]
+
+    kkt=scipy.sparse.bmat([[a.T @ a,c.T],[c,None]],format='csc')
+    lu=scipy.sparse.linalg.splu(kkt)
+    p=lu.solve(np.concatenate((rhs,np.zeros(ncomp))))[:nfile]
+
+    perr=None
+    if (errors):
+        _,labels=pair_components(xifl,xjfl,nfile)
+        perr=np.sqrt(np.clip(covariance_diagonal(a.T @ a,labels,method=emethod,nprobe=nprobe,seed=seed,block=block),0.0,None))
+    return p,perr
+
+
+################################################
+def selected_inverse_diagonal(mat):
+    """
+    Diagonal of the inverse of a sparse symmetric positive definite matrix by selected inversion (the Takahashi recurrence):
+    with the symmetric factorization P A P^T = L D L^T, the entries Z of the inverse on the pattern of L are found column by column
+    from the last one, Z[R,j] = -Z[R,R] L[R,j] and Z[j,j] = 1/d[j] - L[R,j]^T Z[R,j] (R = rows of column j of L below the diagonal),
+    which only needs entries of Z on the pattern of L.  The cost is that of the factorization, not of nfile solves.
+    Args:
+        mat (scipy.sparse matrix): The symmetric positive definite matrix.
+    Returns:
+        tuple: The diagonal of the inverse (None if the factorization needed off-diagonal pivots) and the factorization (splu).
+    """
+    n=mat.shape[0]
+    lu=scipy.sparse.linalg.splu(scipy.sparse.csc_matrix(mat),permc_spec='MMD_AT_PLUS_A',diag_pivot_thresh=0.0,options={'SymmetricMode':True})
+    if (not(np.array_equal(lu.perm_r,lu.perm_c))):
+        return None,lu
+    lmat=lu.L.tocsc()
+    lmat.sort_indices()
+    d=lu.U.diagonal()
+    ip=lmat.indptr
+    ix=lmat.indices
+    # position of the entry (row,col) of L is found from the sorted key col*n+row
+    keys=np.repeat(np.arange(n,dtype=np.int64),np.diff(ip))*n+ix
+    z=np.zeros(ix.size,dtype=np.float64)
+    zdiag=np.zeros(n,dtype=np.float64)
+    for j in range(n-1,-1,-1):
+        s=ip[j]
+        e=ip[j+1]
+        low=(ix[s:e] > j)
+        rows=ix[s:e][low]
+        lval=lmat.data[s:e][low]
+        if (rows.size > 0):
+            want=np.minimum.outer(rows,rows).astype(np.int64)*n+np.maximum.outer(rows,rows)
+            pos=np.minimum(np.searchsorted(keys,want),keys.size-1)
+            if (not(np.array_equal(keys[pos],want))):
+                return None,lu
+            zcol=-(z[pos] @ lval)
+            z[s:e][low]=zcol
+            zdiag[j]=1.0/d[j]-lval @ zcol
+        else:
+            zdiag[j]=1.0/d[j]
+        z[s:e][~low]=zdiag[j]
+    return zdiag[lu.perm_c],lu
+
+
+################################################
+def covariance_diagonal(nmat,labels,method='exact',nprobe=64,seed=0,block=256):
+    """
+    Diagonal of the covariance of the offsets (with zero sum in each connected group) from the sparse normal matrix,
+    without forming the dense covariance.
+    The gauge is fixed by dropping the first image of each group (the normal matrix of the rest, G^-1, is positive definite)
+    and the zero-sum covariance is P G P with P = I - 1 1^T/n in each group, so its diagonal is
+    G_ii - 2 (G 1)_i/n + 1^T G 1/n^2, which needs diag(G) and one more solve.
+    Args:
+        nmat (scipy.sparse matrix): The (nfile x nfile) normal matrix A^T W A.
+        labels (numpy.ndarray): The connected group of each image (see pair_components).
+        method (str): 'exact' computes diag(G) by selected inversion (see selected_inverse_diagonal),
+            'hutchinson' estimates it as sum(z*x)/sum(z*z) with x the solution for nprobe random +-1 probes z
+            (fast, but noisy when the off-diagonal covariances are large, as for a large contiguous footprint).
+        nprobe (int): Number of probes for method='hutchinson'.
+        seed (int): Random seed of the probes.
+        block (int): Number of right hand sides solved at a time.
+    Returns:
+        numpy.ndarray: The diagonal (nfile).
+    """
+    nfile=labels.size
+    nimg=np.bincount(labels).astype(np.float64)
+    root=np.zeros(nfile,dtype=bool)
+    root[np.unique(labels,return_index=True)[1]]=True
+    keep=np.flatnonzero(~root)
+    gdiag=np.zeros(nfile,dtype=np.float64)
+    gone=np.zeros(nfile,dtype=np.float64)
+    if (keep.size > 0):
+        red=scipy.sparse.csc_matrix(nmat)[keep][:,keep]
+        dg=None
+        if (method == 'exact'):
+            dg,lu=selected_inverse_diagonal(red)
+        else:
+            lu=scipy.sparse.linalg.splu(red.tocsc())
+        if ((dg is None)and(method == 'hutchinson')):
+            rng=np.random.default_rng(seed)
+            dg=np.zeros(keep.size,dtype=np.float64)
+            for k0 in range(0,nprobe,block):
+                z=rng.choice([-1.0,1.0],size=(keep.size,min(block,nprobe-k0)))
+                dg+=np.sum(z*lu.solve(z),axis=1)
+            dg/=nprobe
+        elif (dg is None):
+            # the factorization pivoted, so solve for blocks of unit vectors instead
+            dg=np.zeros(keep.size,dtype=np.float64)
+            for k0 in range(0,keep.size,block):
+                k1=min(k0+block,keep.size)
+                e=np.zeros((keep.size,k1-k0),dtype=np.float64)
+                e[np.arange(k0,k1),np.arange(k1-k0)]=1.0
+                dg[k0:k1]=lu.solve(e)[np.arange(k0,k1),np.arange(k1-k0)]
+        gdiag[keep]=dg
+        gone[keep]=lu.solve(np.ones(keep.size))
+    gsum=np.bincount(labels,weights=gone,minlength=nimg.size)
+    return gdiag-2.0*gone/nimg[labels]+gsum[labels]/nimg[labels]**2
 
+
+################################################
+def image_errors(xifl,xjfl,nfile,sval=None,method='exact',nprobe=64,seed=0):
+    """
+    Per-image errors of the offsets fitted with uncertainties sval (as solve_sparse(..., errors=True)) from the sparse normal matrix,
+    for fits that did not factorize it (curve_fit, incremental refit).  See covariance_diagonal for method, nprobe and seed.
+    """
+    nmat,_=normal_equations(xifl,xjfl,np.zeros(xifl.size),nfile,sval=sval)
+    _,labels=pair_components(xifl,xjfl,nfile)
+    return np.sqrt(np.clip(covariance_diagonal(nmat,labels,method=method,nprobe=nprobe,seed=seed),0.0,None))
+
+
+################################################
+def bootstrap_guess(xifl,xjfl,y,nfile,c=None,s=None):
+    """
+    Initial guess of the offsets from a walk over the most reliable pairs.
+    The pairs form a graph of the images.  A minimum spanning tree of it, with pairs weighted by s/sqrt(c) (the error of
+    the median offset, so the most reliable pairs are used), is rooted at the first image of each connected group,
+    and the offsets are accumulated from each root along the tree (p[j] = p[i] + y for a pair (i,j)).
+    All the work is done on sparse (CSR) matrices and by pointer jumping over the tree, in close to linear time.
+    Args:
+        xifl, xjfl (numpy.ndarray): Image indices of each pair measurement.
+        y (numpy.ndarray): Measured offsets.
+        nfile (int): Number of images.
+        c, s (numpy.ndarray): Optional number of pixels and std of each measurement (equal weights if not given).
+    Returns:
+        tuple: The initial guess (0 for the root of each group) and the number of connected groups.
+    """
+    xifl=np.asarray(xifl,dtype=np.int64)
+    xjfl=np.asarray(xjfl,dtype=np.int64)
+    if ((c is None)or(s is None)):
+        wt=np.ones(xifl.size,dtype=np.float64)
+    else:
+        wt=np.asarray(s,dtype=np.float64)/np.sqrt(np.maximum(np.asarray(c,dtype=np.float64),1.0))
+    # csgraph ignores zero weights, so keep them small but positive
+    wt=np.maximum(wt,1.0e-12)
+
+    # one edge per image pair (the best measurement), stored with the offset from its lower to its higher index
+    lo=np.minimum(xifl,xjfl)
+    hi=np.maximum(xifl,xjfl)
+    yl=np.where(xifl < xjfl,y,-np.asarray(y,dtype=np.float64))
+    order=np.lexsort((wt,hi,lo))
+    first=np.ones(order.size,dtype=bool)
+    first[1:]=(lo[order][1:] != lo[order][:-1])|(hi[order][1:] != hi[order][:-1])
+    sel=order[first&(lo[order] != hi[order])]
+    lo,hi,yl,wt=lo[sel],hi[sel],yl[sel],wt[sel]
+
+    graph=scipy.sparse.csr_matrix((wt,(lo,hi)),shape=(nfile,nfile))
+    tree=minimum_spanning_tree(graph)
+    tree=tree+tree.T
+    ncomp,labels=connected_components(tree,directed=False)
+
+    # parent of every image in the tree rooted at the first image of its group (roots are their own parent),
+    # from a single breadth first walk that starts at an extra node linked to all the roots
+    roots=np.unique(labels,return_index=True)[1]
+    link=scipy.sparse.csr_matrix((np.ones(roots.size),(roots,np.full(roots.size,nfile))),shape=(nfile+1,nfile+1))
+    tree=scipy.sparse.bmat([[tree,None],[None,scipy.sparse.csr_matrix((1,1))]],format='csr')+link+link.T
+    _,pred=breadth_first_order(tree,nfile,directed=False,return_predecessors=True)
+    parent=pred[:nfile].astype(np.int64)
+    parent[roots]=roots
+
+    # offset of each image relative to its parent, from the edge values (lo -> hi is +yl)
+    edge=scipy.sparse.csr_matrix((yl,(lo,hi)),shape=(nfile,nfile))
+    edge=(edge-edge.T).tocsr()
+    off=np.asarray(edge[parent,np.arange(nfile)]).ravel()
+
+    # accumulate along the tree by pointer jumping: a0[k] is the offset of k relative to jump[k], until jump[k] is the root
+    a0=off
+    jump=parent
+    while (np.any(jump != jump[jump])):
+        a0=a0+a0[jump]
+        jump=jump[jump]
+    return a0,ncomp
+
+
+################################################
+def normal_equations(xifl,xjfl,y,nfile,sval=None):
+    """
+    The normal equations (A^T W A) p = A^T W y of the linear offset model, as a sparse (CSR) matrix and right hand side.
+    They are sums over the pair measurements, so measurements can be added or removed by adding or subtracting their terms.
+    """
+    a=incidence_matrix(xifl,xjfl,nfile,sval=sval)
+    if (sval is None):
+        rhs=a.T @ y
+    else:
+        rhs=a.T @ (y/sval)
+    return (a.T @ a).tocsr(),rhs
+
+
+################################################
+def save_state(filename,names,xifl,xjfl,y,s,aopt,labels=None,robust=None):
+    """
+    Save what an incremental refit needs (see refit_incremental): the image names, the pair measurements,
+    the normal equations of the weighted fit (sval=s/20) in sparse form, the connected group of each image and the solution.
+    A robust fit (robust = its loss) is recorded so it is not updated as a plain weighted fit later.
+    """
+    nmat,rhs=normal_equations(xifl,xjfl,y,len(names),sval=s/20.)
+    if (labels is None):
+        _,labels=pair_components(xifl,xjfl,len(names))
+    np.savez(filename,names=np.array(names),xifl=xifl,xjfl=xjfl,y=y,s=s,aopt=aopt,labels=labels,
+             robust=np.array("" if (robust is None) else robust),
+             ndata=nmat.data,nindices=nmat.indices,nindptr=nmat.indptr,rhs=rhs)
+
+
+################################################
+def load_state(filename):
+    """
+    Load a state written by save_state as a dictionary (with the normal equations matrix rebuilt as 'nmat').
+    """
+    with np.load(filename) as npz:
+        state={key:npz[key] for key in npz.files}
+    nfile=state['names'].size
+    state['nmat']=scipy.sparse.csr_matrix((state['ndata'],state['nindices'],state['nindptr']),shape=(nfile,nfile))
+    return state
+
+
+################################################
+def grounded_solve(nmat,rhs,labels):
+    """
+    Solve the (singular) normal equations nmat p = rhs with zero mean offset in each connected group of images:
+    the first image of each group is fixed at 0 (the rest of the matrix is positive definite and is factorized
+    symmetrically), then each group is offset to zero mean.
+    """
+    nfile=labels.size
+    root=np.zeros(nfile,dtype=bool)
+    root[np.unique(labels,return_index=True)[1]]=True
+    keep=np.flatnonzero(~root)
+    p=np.zeros(nfile,dtype=np.float64)
+    if (keep.size > 0):
+        red=scipy.sparse.csc_matrix(nmat)[keep][:,keep]
+        lu=scipy.sparse.linalg.splu(red,permc_spec='MMD_AT_PLUS_A',diag_pivot_thresh=0.0,options={'SymmetricMode':True})
+        p[keep]=lu.solve(np.asarray(rhs,dtype=np.float64)[keep])
+    nimg=np.bincount(labels)
+    return p-(np.bincount(labels,weights=p)/nimg)[labels]
+
+
+################################################
+def refit_incremental(state,names,xifl,xjfl,y,s,verbose=0):
+    """
+    Update the weighted fit of a previous run (state from load_state) to a new set of pair measurements.
+    Pairs (by image names) that were removed or changed are found by comparing sorted pair keys and have their terms
+    subtracted from the stored normal equations, the equations are reindexed to the new image list only if it changed
+    (dropping removed images) and the new or changed pairs are added, so updating the equations costs in proportion to the change.
+    The stored connected groups are kept unless a removed pair or a pair between groups can change them.
+    The system is then solved directly (one sparse symmetric factorization, as fast as a few conjugate gradient iterations),
+    with zero mean in each connected group of images (as solve_sparse).
+    Args:
+        state (dict): Previous state (see load_state).
+        names (list): Image names, in the order of the new offsets.
+        xifl, xjfl, y, s (numpy.ndarray): The new pair measurements.
+        verbose (int): The verbosity level.
+    Returns:
+        tuple: Offsets (zero mean in each connected group), as solve_sparse(..., sval=s/20.), and the group of each image.
+    """
+    oldnames=state['names'].astype(str)
+    nold=oldnames.size
+    nfile=len(names)
+    same=((nold == nfile)and(np.array_equal(oldnames,np.asarray(names,dtype=str))))
+    if (same):
+        omap=np.arange(nold)
+    else:
+        newindex={n:k for k,n in enumerate(names)}
+        omap=np.array([newindex.get(n,-1) for n in oldnames],dtype=np.int64)
+
+    # old pairs in the new image numbering (-1 if an image is gone), matched to the new pairs by key
+    oi=omap[state['xifl']]
+    oj=omap[state['xjfl']]
+    okey=np.where((oi >= 0)&(oj >= 0),oi.astype(np.int64)*nfile+oj,-1)
+    nkey=np.asarray(xifl,dtype=np.int64)*nfile+xjfl
+    order=np.argsort(okey,kind='stable')
+    pos=np.minimum(np.searchsorted(okey[order],nkey),max(okey.size-1,0))
+    match=np.zeros(nkey.size,dtype=bool)
+    if (okey.size > 0):
+        cand=order[pos]
+        match=((okey[cand] == nkey)&(state['y'][cand] == y)&(state['s'][cand] == s))
+    kept=np.zeros(okey.size,dtype=bool)
+    if (okey.size > 0):
+        kept[order[pos[match]]]=True
+    removed=np.flatnonzero(~kept)
+    added=np.flatnonzero(~match)
+    if (verbose > 0):
+        print("Incremental refit: {:d} pairs removed/changed, {:d} added/changed, {:d} -> {:d} images".format(removed.size,added.size,nold,nfile))
+
+    # remove old terms (in the old image order)
+    nmat=state['nmat']
+    rhs=state['rhs']
+    if (removed.size > 0):
+        dmat,drhs=normal_equations(state['xifl'][removed],state['xjfl'][removed],state['y'][removed],nold,sval=state['s'][removed]/20.)
+        nmat=nmat-dmat
+        rhs=rhs-drhs
+
+    # reindex to the new image order (images no longer present only had removed pairs left)
+    if (not(same)):
+        keep=np.flatnonzero(omap >= 0)
+        pmat=scipy.sparse.csr_matrix((np.ones(keep.size),(omap[keep],keep)),shape=(nfile,nold))
+        nmat=(pmat @ nmat @ pmat.T).tocsr()
+        rhs=pmat @ rhs
+
+    # add new terms
+    if (added.size > 0):
+        dmat,drhs=normal_equations(xifl[added],xjfl[added],y[added],nfile,sval=s[added]/20.)
+        nmat=nmat+dmat
+        rhs=rhs+drhs
+
+    # the groups can only change if an image or a pair went away, or a new pair joins two groups
+    labels=state.get('labels')
+    if ((labels is None)or(not(same))or(removed.size > 0)or(np.any(labels[xifl[added]] != labels[xjfl[added]]))):
+        _,labels=pair_components(xifl,xjfl,nfile)
+
+    return grounded_solve(nmat,rhs,labels),labels
+
+
+################################################
+def read_offsets(filename):
+    """
+    Read the offset (pair) measurements written by findoff (text file, or npz written with findoff --format npz).
+    Args:
+        filename (str): The findoff output file.
+    Returns:
+        tuple: (fdict, pairs) with fdict mapping image number (from 1) to image name and pairs a structured array (PAIR_DTYPE) with one row per pair measurement:
+            the 0-based image indices (i, j), the median offset (offset), the number of pixels (npix), the std (sigma) and the pair count (pnum).
+    """
+    if (zipfile.is_zipfile(filename)):
+        return read_offsets_npz(filename)
+    f=open(filename,'r')
     flist=True
     fdict={}
-    y=[]
-    x=[]
-    xifl=[]
-    xjfl=[]
-    c=[]
-    s=[]
+    rows=[]
     for line in f:
         cols=line.split()
         if (not(flist)):
             # end of filelist. Get offset values from findoff output
-            y.append(float(cols[0])) # get median offset / medoff
-            x.append(float(cols[1])) # get count
-            ifile=int(cols[2]) # get iImage inum
-            jfile=int(cols[3]) # get jImage jnum
-            xifl.append(ifile-1) # subtract 1 because count started from 1
-            xjfl.append(jfile-1) # subtract 1 because count started from 1
-            c.append(int(cols[4])) # get count/ npix
-            s.append(float(cols[5])) # get medsig/ std deviation
-            
-            diff[ifile-1,jfile-1]=float(cols[0])  # The offset for the pair (ifile, jfile) is stored 
-            diff[jfile-1,ifile-1]=-float(cols[0]) # The offset for the reverse pair (jfile, ifile) is stored as the negative of the original offset
-            nover[ifile-1,jfile-1]=int(cols[4]) # The number of overlapping pixels for the pair (ifile, jfile) is stored
-            sigma[ifile-1,jfile-1]=float(cols[5]) # The standard deviation for the pair (ifile, jfile) is stored
-            ldiff[ifile-1,jfile-1]=True  # valid offset measurement is set to True for the image pairs
+            # iImage inum and jImage jnum (subtract 1 because count started from 1), median offset / medoff, count/ npix, medsig/ std deviation, pair count
+            rows.append((int(cols[2])-1,int(cols[3])-1,float(cols[0]),int(cols[4]),float(cols[5]),float(cols[1])))
         if (cols[0]=="END"):
             flist=False
-            nfile=len(fdict)
-            # initialization of diff, nover, sigma, ldiff matrices
-            diff=np.zeros((nfile,nfile),dtype=np.float64)
-            nover=np.zeros((nfile,nfile),dtype=np.int32)
-            sigma=np.zeros((nfile,nfile),dtype=np.float64)
-            ldiff=np.zeros((nfile,nfile),dtype=np.bool_)
         if (flist):
             fdict[int(cols[0])]=cols[1]
     f.close()
+
+    pairs=np.array(rows,dtype=PAIR_DTYPE)
+    return fdict,pairs
+
+
+################################################
+def read_offsets_npz(filename):
+    """
+    Read the offset (pair) measurements from the binary columns written by findoff.write_offsets_npz (see read_offsets).
+    The full precision columns are copied straight into the pairs array (no text parsing).
+    """
+    with np.load(filename) as npz:
+        fdict={int(inum):str(fname) for inum,fname in zip(npz['image_inum'],npz['image_fname'])}
+        pairs=np.empty(npz['inum'].size,dtype=PAIR_DTYPE)
+        pairs['i']=npz['inum']-1
+        pairs['j']=npz['jnum']-1
+        for key in ['offset','npix','sigma','pnum']:
+            pairs[key]=npz[key]
+    return fdict,pairs
+
+
+################################################
+def write_offsets_text(filename,fdict,pairs):
+    """
+    Write pair measurements (from read_offsets) in the findoff text format, e.g. to export an npz offset file.
+    """
+    fout=open(filename,'w')
+    for inum in sorted(fdict):
+        fout.write(" {inum:6d} {fname:s} \n".format(inum=inum,fname=fdict[inum]))
+    fout.write("END OF FILELIST\n")
+    for row in pairs:
+        fout.write(" {offval:11.3f} {cval:11.3f} {inum:6d} {jnum:6d} {pixval:10d} {offsig:12.4f} \n".format(
+            offval=row['offset'],
+            cval=row['pnum'],
+            inum=row['i']+1,
+            jnum=row['j']+1,
+            pixval=row['npix'],
+            offsig=row['sigma']))
+    fout.close()
+
+
+################################################
+def robust_weights(u,loss='huber',tune=None):
+    """
+    IRLS weights of the normalized residuals u for the Huber (default tune=1.345) or Tukey biweight (default tune=4.685) loss.
+    """
+    au=np.abs(u)
+    if (loss == 'huber'):
+        if (tune is None):
+            tune=1.345
+        return np.minimum(1.0,tune/np.maximum(au,1.0e-300))
+    if (tune is None):
+        tune=4.685
+    return np.where(au < tune,(1.0-(u/tune)**2)**2,0.0)
+
+
+################################################
+def group_scale(u,plabel):
+    """
+    Robust (MAD) scale of the normalized residuals u of the pairs in each connected group (plabel = group of each pair).
+    Returns:
+        numpy.ndarray: The scale of the group of each pair.
+    """
+    scale=np.zeros(u.size,dtype=np.float64)
+    order=np.argsort(plabel,kind='stable')
+    bounds=np.flatnonzero(np.diff(plabel[order]))+1
+    for idx in np.split(order,bounds):
+        if (idx.size > 0):
+            scale[idx]=1.4826*np.median(np.abs(u[idx]))
+    return scale
+
+
+################################################
+def solve_robust(xifl,xjfl,y,nfile,sval=None,loss='huber',tune=None,maxiter=100,tol=1.0e-6,wmin=1.0e-10,errors=False,emethod='exact',nprobe=64,seed=0,verbose=0):
+    """
+    Solve the linear offset model (as solve_sparse) with iteratively reweighted least squares, so outlier pairs are down-weighted.
+    Each iteration reweights the pairs from their residuals, normalized by sval and by a robust (MAD) scale of their
+    connected group of images (so an outlier in one group does not change the weights of another), and re-solves.
+    Huber iterations are always run first; for loss='tukey' the redescending loss is then iterated from the Huber solution
+    with the scale of each group fixed at its Huber value (from the least-squares solution it can lock onto the outliers),
+    and with the Huber weight as the lowest weight of a pair.
+    The normal matrix (plus C^T C for the gauge, which keeps it positive definite with the same solution) is factorized once
+    for the starting weights and that factorization preconditions a conjugate gradient solve for the new weights,
+    which starts from the previous solution; only the final solve (with the errors) is a new factorization.
+    Args:
+        xifl, xjfl (numpy.ndarray): Image indices of each pair measurement.
+        y (numpy.ndarray): Measured offsets.
+        nfile (int): Number of images.
+        sval (numpy.ndarray): Optional uncertainty of each measurement (None = equal weights).
+        loss (str): 'huber' or 'tukey'.
+        tune (float): Optional tuning constant of the loss (in units of the robust scale).
+        maxiter (int): Maximum number of reweighting iterations of each loss (they are cheap preconditioned CG solves;
+            Huber has to converge before the redescending loss starts, or it rejects the good pairs next to an outlier).
+        tol (float): Stop when the offsets change by less than tol (relative to the largest offset).
+        wmin (float): Smallest weight, so a pair given zero weight can not disconnect a group of images
+            (it must stay well below the Huber weights of gross outliers, or they pull on the images around them).
+        errors (bool): Also compute the per-image errors (with the final weights, see solve_sparse for emethod, nprobe and seed).
+    Returns:
+        tuple: Offsets (zero mean in each connected group), per-image errors (None unless errors=True) and the final weight of each pair.
+    """
+    if (sval is None):
+        sval=np.ones(y.size,dtype=np.float64)
+    ncomp,labels=pair_components(xifl,xjfl,nfile)
+    plabel=labels[xifl]
+    cmat=scipy.sparse.csr_matrix((np.ones(nfile),(labels,np.arange(nfile))),shape=(ncomp,nfile))
+    gauge=(cmat.T @ cmat).tocsc()
+    a=incidence_matrix(xifl,xjfl,nfile)
+
+    w=np.ones(y.size,dtype=np.float64)
+    p,_=solve_sparse(xifl,xjfl,y,nfile,sval=sval)
+    lu=scipy.sparse.linalg.splu((a.T @ scipy.sparse.diags(1.0/sval**2) @ a + gauge).tocsc())
+    precond=scipy.sparse.linalg.LinearOperator((nfile,nfile),matvec=lu.solve,dtype=np.float64)
+    stages=[('huber',tune if (loss == 'huber') else None)]
+    if (loss == 'tukey'):
+        stages.append(('tukey',tune))
+    scale=None
+    for sloss,stune in stages:
+        for it in range(maxiter):
+            u=(y-(p[xjfl]-p[xifl]))/sval
+            if (sloss == 'huber'):
+                scale=group_scale(u,plabel)
+            # pairs of a group without redundancy (zero scale) fit exactly and keep their full weight
+            ok=(scale > 0.0)
+            w=np.ones(y.size,dtype=np.float64)
+            w[ok]=robust_weights(u[ok]/scale[ok],loss=sloss,tune=stune)
+            if (sloss == 'tukey'):
+                # never below the Huber weight: gross outliers still go to ~0, but the good pairs next to an outlier
+                # can not all be rejected (which would leave their image to the outlier)
+                w[ok]=np.maximum(w[ok],robust_weights(u[ok]/scale[ok],loss='huber'))
+            w=np.maximum(w,wmin)
+            wt=w/sval**2
+            nmat=(a.T @ scipy.sparse.diags(wt) @ a + gauge).tocsr()
+            pnew,info=scipy.sparse.linalg.cg(nmat,a.T @ (wt*y),x0=p,rtol=1.0e-12,maxiter=10*nfile,M=precond)
+            if (info != 0):
+                pnew=scipy.sparse.linalg.spsolve(nmat.tocsc(),a.T @ (wt*y))
+            dp=np.amax(np.abs(pnew-p)) if (nfile > 0) else 0.0
+            p=pnew
+            if (verbose > 0):
+                print("# Robust ({:s}) iteration {:d}: max scale={:.4f} max change={:.3e} down-weighted={:d}".format(sloss,it+1,np.amax(scale) if (scale.size > 0) else 0.0,dp,np.count_nonzero(w < 0.5)))
+            if (dp <= tol*max(1.0,np.amax(np.abs(p)))):
+                break
+
+    # an image (or a group) with most of its pairs rejected has no consistent majority, so its offset is not to be trusted
+    good=np.zeros(nfile,dtype=np.int64)
+    np.add.at(good,xifl[w >= 0.5],1)
+    np.add.at(good,xjfl[w >= 0.5],1)
+    npair=np.bincount(xifl,minlength=nfile)+np.bincount(xjfl,minlength=nfile)
+    lost=np.flatnonzero((npair > 0)&(good == 0))
+    if (lost.size > 0):
+        print("Warning: robust fit down-weighted all the pairs of {:d} image(s): {:s}".format(lost.size," ".join(str(k+1) for k in lost[:20])))
+    for k in np.unique(plabel):
+        sel=(plabel == k)
+        nrej=np.count_nonzero(w[sel] < 0.5)
+        if (2*nrej > np.count_nonzero(sel)):
+            print("Warning: robust fit down-weighted {:d} of the {:d} pairs of the group of image {:d}".format(nrej,np.count_nonzero(sel),np.flatnonzero(labels == k)[0]+1))
+
+    perr=None
+    if (errors):
+        p,perr=solve_sparse(xifl,xjfl,y,nfile,sval=sval/np.sqrt(w),errors=True,emethod=emethod,nprobe=nprobe,seed=seed)
+    return p,perr,w
+
+
+################################################
+def _fit_component(task):
+    """
+    Fit the offsets of one connected group of images (a task of solve_components).
+    """
+    ci,cj,y,sval,p0,solver,errors,eopts=task
+    n=p0.size
+    if (y.size == 0):
+        return np.zeros(n),(np.zeros(n) if (errors) else None)
+    if ((solver == 'sparse')or(y.size < n)):
+        return solve_sparse(ci,cj,y,n,sval=sval,errors=errors,**eopts)
+
+    def model(x,*p):
+        p=np.asarray(p)
+        return p[cj]-p[ci]
+
+    p,_=curve_fit(model,np.arange(y.size,dtype=np.float64),y,p0=p0,sigma=sval,absolute_sigma=(sval is not None),method='trf')
+    perr=None
+    if (errors):
+        perr=image_errors(ci,cj,n,sval=sval,method=eopts.get('emethod','exact'),nprobe=eopts.get('nprobe',64),seed=eopts.get('seed',0))
+    return p,perr
+
+
+################################################
+def solve_components(xifl,xjfl,y,nfile,sval=None,errors=False,solver='sparse',p0=None,workers=1,verbose=0,**eopts):
+    """
+    Fit the offsets of each connected group of images of the pair graph on its own, in parallel, with the median offset
+    of each group set to 0.  Groups share no pairs, so this is the same fit as over all images, but the wall time
+    follows the largest group and curve_fit is not degenerate when the images split into groups.
+    Args:
+        xifl, xjfl (numpy.ndarray): Image indices of each pair measurement.
+        y (numpy.ndarray): Measured offsets.
+        nfile (int): Number of images.
+        sval (numpy.ndarray): Optional uncertainty of each measurement (None = equal weights).
+        errors (bool): Also compute the per-image errors.
+        solver (str): 'sparse' (solve_sparse) or 'curve_fit' (scipy.optimize.curve_fit from p0).
+        p0 (numpy.ndarray): Initial guess for solver='curve_fit' (default=0).
+        workers (int): Number of processes (the largest groups are started first).
+        verbose (int): The verbosity level.
+        eopts: emethod, nprobe and seed for the errors (see solve_sparse).
+    Returns:
+        tuple: Offsets (median 0 in each group), per-image errors (None unless errors=True) and the group label of each image.
+    """
+    ncomp,labels=pair_components(xifl,xjfl,nfile)
+    if (p0 is None):
+        p0=np.zeros(nfile,dtype=np.float64)
+    # the image and pair indices of each group (pairs belong to the group of their images)
+    iorder=np.argsort(labels,kind='stable')
+    ibounds=np.searchsorted(labels[iorder],np.arange(ncomp+1))
+    plabel=labels[xifl]
+    porder=np.argsort(plabel,kind='stable')
+    pbounds=np.searchsorted(plabel[porder],np.arange(ncomp+1))
+    local=np.zeros(nfile,dtype=np.int64)
+    local[iorder]=np.arange(nfile)-ibounds[labels[iorder]]
+
+    tasks=[]
+    for k in range(ncomp):
+        imgs=iorder[ibounds[k]:ibounds[k+1]]
+        prs=porder[pbounds[k]:pbounds[k+1]]
+        tasks.append((local[xifl[prs]],local[xjfl[prs]],y[prs],None if (sval is None) else sval[prs],p0[imgs],solver,errors,eopts))
+    if (verbose > 0):
+        sizes=np.diff(ibounds)
+        print("# Fitting {:d} connected group(s) of images (largest {:d} images)".format(ncomp,np.amax(sizes) if (ncomp > 0) else 0))
+
+    # the largest groups first, so the pool is not left waiting on a big group at the end
+    order=np.argsort(-np.diff(pbounds),kind='stable')
+    if ((workers > 1)and(ncomp > 1)):
+        with multiprocessing.Pool(min(workers,ncomp)) as pool:
+            res=pool.map(_fit_component,[tasks[k] for k in order],chunksize=max(1,ncomp//(4*workers)))
+    else:
+        res=[_fit_component(tasks[k]) for k in order]
+
+    p=np.zeros(nfile,dtype=np.float64)
+    perr=np.zeros(nfile,dtype=np.float64) if (errors) else None
+    for k,(pk,ek) in zip(order,res):
+        imgs=iorder[ibounds[k]:ibounds[k+1]]
+        p[imgs]=pk-np.median(pk)
+        if (errors):
+            perr[imgs]=ek
+    return p,perr,labels
+
+
+################################################
+def write_groups(filename,fdict,labels):
+    """
+    Write the connected group (from 0, largest group first) of each image: image number, image name, group and group size.
+    """
+    sizes=np.bincount(labels)
+    rank=np.zeros(sizes.size,dtype=np.int64)
+    rank[np.argsort(-sizes,kind='stable')]=np.arange(sizes.size)
+    fout=open(filename,'w')
+    for i in range(labels.size):
+        fout.write(" {inum:6d} {fname:s} {group:6d} {nimg:6d} \n".format(inum=i+1,fname=fdict[i+1],group=rank[labels[i]],nimg=sizes[labels[i]]))
+    fout.close()
+
+
+################################################
+def fit_sparse(xifl,xjfl,y,s,nfile,emethod='exact',nprobe=64):
+    """
+    The fit done by the sparse solver: an equal weight solution followed by the solution weighted by sval=s/20,
+    each with median 0 in every connected group of images (errors computed with emethod and nprobe, see solve_sparse).
+    Returns:
+        tuple: (aopt2, aerr, aopt) the weighted offsets, their errors, and the equal weight offsets.
+    """
+    aopt,_,_=solve_components(xifl,xjfl,y,nfile)
+    aopt2,aerr,_=solve_components(xifl,xjfl,y,nfile,sval=s/20.,errors=True,emethod=emethod,nprobe=nprobe)
+    return aopt2,aerr,aopt
+
+
+################################################
+def write_downweighted(filename,fdict,xifl,xjfl,y,aopt,wt,wcut=0.5):
+    """
+    Write the pairs down-weighted by a robust fit (weight < wcut), from the lowest weight: image numbers, names, offset, residual and weight.
+    """
+    fout=open(filename,'w')
+    for k in np.argsort(wt,kind='stable'):
+        if (wt[k] >= wcut):
+            break
+        fout.write(" {inum:6d} {jnum:6d} {iname:s} {jname:s} {offval:11.3f} {resid:11.3f} {wval:8.4f} \n".format(
+            inum=xifl[k]+1,
+            jnum=xjfl[k]+1,
+            iname=fdict[xifl[k]+1],
+            jname=fdict[xjfl[k]+1],
+            offval=y[k],
+            resid=y[k]-(aopt[xjfl[k]]-aopt[xifl[k]]),
+            wval=wt[k]))
+    fout.close()
+
+
+################################################
+def write_zcom(filename,fdict,aopt,aerr=None):
+    """
+    Write the per image offsets (a zcom file, the input of zoff_apply): image name and offset per line,
+    followed by the error of the offset when aerr is given.
+    """
+    fout=open(filename,'w')
+    for i in range(aopt.size):
+        if (aerr is None):
+            fout.write(" {:s} {:f} \n".format(fdict[i+1],aopt[i]))
+        else:
+            fout.write(" {:s} {:f} {:f} \n".format(fdict[i+1],aopt[i],aerr[i]))
+    fout.close()
+
+
+################################################
+if __name__ == "__main__":
+    # usage `python3 fitoff.py -i "out/test.g.offset_b8" -o "out/test.g.zoff_b8" -b -v 2`
+    parser = argparse.ArgumentParser(description='Code to take offset measurement and find optimal set of per image offsets for the ensemble') 
+
+    parser.add_argument('-i','--input',   action='store', type=str, default=None, required=True,  help='Input offset (pair) measurements from findoff_WCS (text or npz).')
+    parser.add_argument('-o','--output',  action='store', type=str, default=None, required=True,  help='Output file of optimal (per image) offsets (a zcom file).')
+    parser.add_argument('-e','--exclude', action='store', type=str, default=None, required=False, help='Exclude file (list of images numbers to exclude)')
+    parser.add_argument('-d','--diag',    action='store', type=str, default=None, required=False, help='Diagnostic file (optional output).')
+    parser.add_argument('-w','--weight',  action='store', type=int, default=0,    required=False, help='Weighting mode (0=equal weightdefault), 1=overlap (1/sqrt(#pix)), 2=sigma (1/RMS(offset)))')
+    parser.add_argument('-v','--verbose', action='store', type=int, default=0,    required=False, help='Verbosity (default=0, max=2)')
+    parser.add_argument('-b','--boot',    action='store_true', default=False,     required=False, help='Use bootstrap to make an intial guess)')
+    parser.add_argument('-s','--solver',  action='store', type=str, default='curve_fit', choices=['curve_fit','sparse'], help='Solver (curve_fit=scipy.optimize.curve_fit (default), sparse=sparse linear least squares)')
+    parser.add_argument('--robust',       action='store', type=str, default=None, choices=['huber','tukey'], help='Optional robust (IRLS) weighted fit that down-weights outlier pairs (pairs with weight < 0.5 are written to --diag)')
+    parser.add_argument('--robust_c',     action='store', type=float, default=None, help='Tuning constant of the --robust loss in units of the robust scale (default=1.345 huber, 4.685 tukey)')
+    parser.add_argument('--errors',       action='store', type=str, default=None, choices=['exact','hutchinson','none'], help='Per-image errors written as a third zcom column, from the sparse normal matrix (exact=selected inversion of the sparse factorization (default, except for an --incremental update: none), hutchinson=stochastic estimate with --nprobe probes, none=no errors)')
+    parser.add_argument('--nprobe',       action='store', type=int, default=64, help='Number of random probes for --errors hutchinson (default=64)')
+    parser.add_argument('--seed',         action='store', type=int, default=0, help='Random seed of the --errors hutchinson probes (default=0)')
+    parser.add_argument('--workers',      action='store', type=int, default=1, help='Number of processes fitting the connected groups of images (default=1)')
+    parser.add_argument('--groups',       action='store', type=str, default=None, help='Optional output file with the connected group of each image (image number, name, group, group size)')
+    parser.add_argument('--state',        action='store', type=str, default=None, help='Optional file (.npz) to save the normal equations and solution of the fit to (for --incremental)')
+    parser.add_argument('--export',       action='store', type=str, default=None, help='Optional file to write the input pair measurements to in the findoff text format (e.g. from an npz input)')
+    parser.add_argument('--incremental',  action='store_true', default=False, help='Update the fit saved in --state with the pairs that changed (if it exists) instead of fitting from scratch')
+
+    args = parser.parse_args()
+    if (args.verbose > 0):
+        print("Args: {:}".format(args))
+
+    #  Initializations
+    # The pair measurements are kept in one structured array (pairs) with a row per measured pair of images (ifile, jfile):
+    # the median offset, the number of overlapping pixels and the standard deviation of the offsets.
+    # x, xifl, xjfl, y, c and s are views of its columns, used by the bootstrap, the fit and the diagnostics.
+
+    fdict,pairs=read_offsets(args.input)
+    x=pairs['pnum']
+    xifl=pairs['i']
+    xjfl=pairs['j']
+    y=pairs['offset']
+    c=pairs['npix']
+    s=pairs['sigma']
+    nfile=len(fdict)
     print("Number of images identified: {:d}".format(len(fdict)))
+    names=[fdict[i+1] for i in range(nfile)]
+    if (args.export is not None):
+        write_offsets_text(args.export,fdict,pairs)
+
+    state=None
+    if ((args.incremental)and(args.state is not None)and(os.path.isfile(args.state))):
+        state=load_state(args.state)
+        if ((args.robust is not None)or(str(state.get('robust','')) != "")):
+            # the robust weights depend on all the residuals, so a robust fit is always redone in full
+            print("# Robust fit: refitting in full instead of updating {:s}".format(args.state))
+            state=None
+    if (state is not None):
+        # update the previous solution with the pairs that changed, instead of fitting from scratch
+        t0=time.time()
+        aopt2,labels=refit_incremental(state,names,xifl,xjfl,y,s,verbose=args.verbose)
+        ncomp=np.unique(labels).size
+        print("# Offseting incremental FIT result by the median of each of {:d} connected group(s)".format(ncomp))
+        aopt2=median_zero(aopt2,labels)
+        if (args.groups is not None):
+            write_groups(args.groups,fdict,labels)
+        # errors need a factorization of the whole system, so they are only computed when asked for
+        aerr=None
+        if ((args.errors is not None)and(args.errors != 'none')):
+            aerr=image_errors(xifl,xjfl,nfile,sval=s/20.,method=args.errors,nprobe=args.nprobe,seed=args.seed)
+        t1=time.time()
+        if (args.verbose > 1):
+            print(aopt2)
+        write_zcom(args.output,fdict,aopt2,aerr)
+        save_state(args.state,names,xifl,xjfl,y,s,aopt2,labels=labels)
+        print("Time to refit {:d} image: {:.2f}".format(aopt2.size,t1-t0))
+        exit(0)
+    if (args.errors is None):
+        args.errors='exact'
 
-    # convert list to numpy arrays
-    x=np.array(x,dtype=np.float64) 
-    xifl=np.array(xifl,dtype=np.int32)
-    xjfl=np.array(xjfl,dtype=np.int32)
-    y=np.array(y,dtype=np.float64) 
-    c=np.array(c,dtype=np.int32) 
-    s=np.array(s,dtype=np.float64) 
-   
     print(np.mean(s)/np.sqrt(s.size) )
 
 #    print(x.size)
@@ -113,49 +858,10 @@ if __name__ == "__main__":
 
     if (args.boot):
         print("# Attempting bootstrap to obtain initial guess")
-        ai=np.arange(nfile)  # store the indices of the images
-        b=np.zeros((nfile),dtype=np.int16)  # store the status of the images
-        w=np.where(xifl==0)  # store the indices of the images where the first image is 0
-        a0[xjfl[w]]=y[w]  # the offset for the pair (0, jfile) is stored. reference image.
-        b[0]=2  # the first image is set to 2
-        b[xjfl[w]]=1  # the second image is set to 1
-
-        print("a0 = ",a0)
-        print(" b = ",b)
-        print("ai = ",ai)
-
-        boot_iter=0
-        w1=np.where(b==1)
-        print("Boostrap iter: {:d} complete".format(boot_iter))
-        # iterative bootstrap process to update the offset
-        while (ai[w1].size > 0):
-            for i in ai[w1]:
-                w2a=np.where(xifl == i)
-                w2b=np.where(xjfl == i)
-                w3a=np.where(b[xjfl[w2a]]==0)
-                w3b=np.where(b[xifl[w2b]]==0)
-
-                if (ai[xjfl[w2a]][w3a].size > 0):
-                    print("NOTEMPTYa")
-                    for j in ai[xjfl[w2a]][w3a]:
-                        a0[j]=a0[i]+diff[i][j]
-                        b[j]=1
-                if (ai[xifl[w2b]][w3b].size > 0):
-                    print("NOTEMPTYb")
-                    for j in ai[xifl[w2b]][w3b]:
-                        a0[j]=a0[i]+diff[i][j]
-                        b[j]=1
-                b[i]=2
-
+        a0,ncomp=bootstrap_guess(xifl,xjfl,y,nfile,c=c,s=s)
+        print("# Bootstrap over {:d} connected group(s) of images".format(ncomp))
+        if (args.verbose > 1):
             print("a0 = ",a0)
-            print(" b = ",b)
-            print("ai = ",ai)
-            w1=np.where(b==1)
-            boot_iter=boot_iter+1
-            print("Boostrap iter: {:d} complete".format(boot_iter))
-
-#       WHILE statement above ends here...
-#   End Bootstrap initiative
 
     a0med=np.median(a0)
     print("# Offseting initial set of initial guesses by median {:f}".format(a0med))
@@ -166,27 +872,39 @@ if __name__ == "__main__":
     #         print(i,y[i],s[i],s[i]/np.sqrt(c[i]),sval[i])
 
 
+    # each connected group of images is fitted on its own (in parallel with --workers), with the median offset of each group set to 0
+    # (with the sparse solver the model is linear, so it is solved directly and the initial guess is not needed)
     t0=time.time()
-    aopt,acov=curve_fit(getoff,x,y,p0=a0,method='trf')
+    aopt,_,labels=solve_components(xifl,xjfl,y,nfile,solver=args.solver,p0=a0,workers=args.workers,verbose=args.verbose)
     t1=time.time()
+    ncomp=np.unique(labels).size
     print("Time to fit {:d} image: {:.2f}".format(aopt.size,t1-t0))
-    print(acov)
-    print(aopt)
-
-    amed=np.median(aopt)
-    print("# Offseting first FIT result by median {:f}".format(amed))
-    aopt=aopt-amed
-    print(aopt)
+    print("# Offseting first FIT result by the median of each of {:d} connected group(s)".format(ncomp))
+    if (args.verbose > 1):
+        print(aopt)
+    if (args.groups is not None):
+        write_groups(args.groups,fdict,labels)
 
     # use scipt.curve_fit to optimize the fit the model get_off
-    aopt2,acov2=curve_fit(getoff,x,y,p0=aopt,sigma=sval,absolute_sigma=True,method='trf')
-    aerr = np.sqrt(np.diag(acov2))
-    print(acov2)
-    print(aopt2)
-    amed=np.median(aopt2)
-    print("# Offseting first FIT result by median {:f}".format(amed))
-    aopt2=aopt2-amed
-    print(aopt2)
+    # the per-image errors come from the sparse normal matrix (not the dense covariance of curve_fit)
+    eopts={'emethod':args.errors,'nprobe':args.nprobe,'seed':args.seed}
+    doerr=(args.errors != 'none')
+    if (args.robust is not None):
+        aopt2,aerr,rwt=solve_robust(xifl,xjfl,y,nfile,sval=sval,loss=args.robust,tune=args.robust_c,errors=doerr,verbose=args.verbose,**eopts)
+        print("# Robust ({:s}) fit down-weighted {:d} of {:d} pairs to weight < 0.5 ({:d} to < 0.1)".format(args.robust,np.count_nonzero(rwt < 0.5),rwt.size,np.count_nonzero(rwt < 0.1)))
+        if (args.diag is not None):
+            write_downweighted(args.diag,fdict,xifl,xjfl,y,aopt2,rwt)
+        sval=sval/np.sqrt(rwt)
+        aopt2=median_zero(aopt2,labels)
+    else:
+        aopt2,aerr,_=solve_components(xifl,xjfl,y,nfile,sval=sval,errors=doerr,solver=args.solver,p0=aopt,workers=args.workers,**eopts)
+    if (aerr is not None):
+        print("# Per-image errors ({:s}): median {:f}, max {:f}".format(args.errors,np.median(aerr),np.amax(aerr)))
+        if (args.verbose > 1):
+            print(aerr)
+    print("# Offseting weighted FIT result by the median of each of {:d} connected group(s)".format(ncomp))
+    if (args.verbose > 1):
+        print(aopt2)
 
     chisq = np.sum(((getoff(x, *aopt2) - y)/sval)**2)
     chisq /= (x.size - aopt2.size)
@@ -194,16 +912,20 @@ if __name__ == "__main__":
 
     # write results to file
     # Write filename and the optimized offset
-    fout=open(args.output,'w')
-    for i in range(aopt.size):
-        if (i < 190):
-#            print(i,fdict[i+1],aopt[i],aerr[i])
-            print(i,fdict[i+1],aopt2[i],aopt[i])
-        fout.write(" {:s} {:f} \n".format(fdict[i+1],aopt2[i]))
-#        print i,fdict[i+1],aopt2[i],aopt[i]
-    fout.close()
-
-    print(np.amin(diff),np.amax(diff),np.amin(aopt),np.amax(aopt))
+    if (args.verbose > 1):
+        for i in range(aopt.size):
+            if (i < 190):
+#                print(i,fdict[i+1],aopt[i],aerr[i])
+                print(i,fdict[i+1],aopt2[i],aopt[i])
+    write_zcom(args.output,fdict,aopt2,aerr)
+    if (args.state is not None):
+        save_state(args.state,names,xifl,xjfl,y,s,aopt2,labels=labels,robust=args.robust)
+
+    # range of the pair offsets, in both directions (offset of jfile-ifile and ifile-jfile)
+    dmax=0.0
+    if (y.size > 0):
+        dmax=np.amax(np.abs(y))
+    print(-dmax,dmax,np.amin(aopt),np.amax(aopt))
 
     print("Time to fit {:d} image: {:.2f}".format(aopt.size,t1-t0))
 
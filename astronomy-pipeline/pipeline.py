@@ -0,0 +1,189 @@
+#! /usr/bin/env python3
+"""
+Method to run the whole pipeline (findoff -> fitoff -> zoff_apply) for every band in one process
+1. Find the bands from the image lists in data/list (sci.<band>.list, with fluxscales in flx.<band>.list)
+2. For each band read the image list, fluxscales, headers and WCS once and share them between the stages
+   (with --catalog the header metadata of all bands come from one catalog, see findoff.header_catalog)
+3. Measure the pair offsets (findoff), fit the per image offsets (fitoff, sparse solver) and apply them (zoff_apply)
+4. Bands are run at the same time with a pool of processes
+5. The intermediate offset and zcom files of the separate scripts are only written with --keep
+6. Usage `python3 pipeline.py -o "out/" --useTAN --keep`
+"""
+
+import os
+import argparse
+import glob
+import re
+import time
+import multiprocessing
+import numpy as np
+import wcsutil
+import findoff
+import fitoff
+import zoff_apply
+
+
+###########################################
+def find_bands(listdir):
+    """
+    Find the bands that have an image list (sci.<band>.list) in listdir.
+    """
+    bands=[]
+    for fname in sorted(glob.glob(os.path.join(listdir,"sci.*.list"))):
+        m=re.match(r"sci\.(.+)\.list$",os.path.basename(fname))
+        if (m is not None):
+            bands.append(m.group(1))
+    return bands
+
+
+###########################################
+def run_band(band,opts):
+    """
+    Run findoff, fitoff and zoff_apply for one band.
+    Args:
+        band (str): The band (e.g. "i").
+        opts (dict): Pipeline options (listdir, outdir, useTAN, keep, minpix, cache_mb, wcscache, catalog, pairstore, mdopts, apply, apply_mode, verbose).
+    Returns:
+        tuple: (band, number of images, number of pairs measured, time in seconds), or (band, 0, 0, time) if images are missing.
+    """
+    t0=time.time()
+    verbose=opts['verbose']
+    listdir=opts['listdir']
+    flist,fdict=findoff.read_image_list(os.path.join(listdir,"sci.{:s}.list".format(band)),useTAN=opts['useTAN'])
+    fluxscale=os.path.join(listdir,"flx.{:s}.list".format(band))
+    if (not(os.path.isfile(fluxscale))):
+        fluxscale=None
+    findoff.read_fluxscales(fdict,fluxscale=fluxscale,useTAN=opts['useTAN'],verbose=verbose)
+    wcscache=None
+    if (opts['wcscache'] is not None):
+        wcscache=wcsutil.WCSCache(opts['wcscache'])
+    if (not(findoff.read_wcs(fdict,flist,wcscache=wcscache,catalog=opts['catalog']))):
+        print("Band {:s}: missing file(s).  Skipping!".format(band))
+        return band,0,0,time.time()-t0
+
+    # findoff
+    ipair,jpair=findoff.find_overlaps(fdict,flist,verbose=verbose)
+    pairs,pcount=findoff.pair_list(flist,ipair,jpair)
+    store=None
+    if (opts['pairstore'] is not None):
+        store=findoff.PairStore(os.path.join(opts['pairstore'],"{:s}.npz".format(band)),verbose=verbose)
+    results=findoff.measure_pairs(fdict,pairs,minpix=opts['minpix'],maxbytes=int(opts['cache_mb']*1024**2),mdopts=opts['mdopts'],store=store,verbose=verbose)
+    if (opts['keep']):
+        findoff.write_offsets(os.path.join(opts['outdir'],"{:s}.offset".format(band)),fdict,flist,pairs,pcount,results,minpix=opts['minpix'])
+    t1=time.time()
+    if (verbose > 0):
+        print("Band {:s}: measured {:d} pairs: {:.2f}".format(band,len(pairs),t1-t0))
+
+    # fitoff (image numbers are 0-based here, the offset file is 1-based)
+    good=[k for k,res in enumerate(results) if (res[2] >= opts['minpix'])]
+    xifl=np.array([fdict[pairs[k][0]]['inum'] for k in good],dtype=np.int32)
+    xjfl=np.array([fdict[pairs[k][1]]['inum'] for k in good],dtype=np.int32)
+    y=np.array([results[k][0] for k in good],dtype=np.float64)
+    s=np.array([results[k][1] for k in good],dtype=np.float64)
+    aopt,aerr,_=fitoff.fit_sparse(xifl,xjfl,y,s,len(flist))
+    if (opts['keep']):
+        fitoff.write_zcom(os.path.join(opts['outdir'],"{:s}.zoff".format(band)),{fdict[Img]['inum']+1:fdict[Img]['fname0'] for Img in flist},aopt,aerr)
+    t2=time.time()
+    if (verbose > 0):
+        print("Band {:s}: fit {:d} offsets: {:.2f}".format(band,aopt.size,t2-t1))
+
+    # zoff_apply (to the listed images, with the fluxscales already read)
+    if (opts['apply']):
+        sidecar=[]
+        for Img in flist:
+            fname0=os.path.join("data",fdict[Img]['fname0'])
+            if (os.path.isfile(fname0)):
+                offval=aopt[fdict[Img]['inum']]/fdict[Img]['fluxscale']/zoff_apply.OFFSET_SCALE
+                if (opts['apply_mode'] == 'sidecar'):
+                    sidecar.append((fdict[Img]['fname0'],offval))
+                else:
+                    zoff_apply.apply_offset(fname0,offval,mode=opts['apply_mode'],verbose=verbose)
+                if (verbose > 1):
+                    print(fname0,aopt[fdict[Img]['inum']],fdict[Img]['fluxscale'],offval)
+            else:
+                print("File: {:s} not found.".format(fname0))
+        if (opts['apply_mode'] == 'sidecar'):
+            zoff_apply.write_sidecar(os.path.join(opts['outdir'],"{:s}.sidecar".format(band)),sidecar)
+    t3=time.time()
+    if (verbose > 0):
+        print("Band {:s}: applied offsets: {:.2f}".format(band,t3-t2))
+
+    return band,len(flist),len(good),t3-t0
+
+
+###########################################
+def _run_band(args):
+    return run_band(*args)
+
+
+###########################################
+if __name__ == "__main__":
+    # usage `python3 pipeline.py -o "out/" --useTAN --keep`
+    t00=time.time()
+    parser = argparse.ArgumentParser(description='Code to run findoff, fitoff and zoff_apply for all bands')
+
+    parser.add_argument('-l','--listdir', action='store', type=str, default=os.path.join("data","list"), help='Directory with the sci.<band>.list and flx.<band>.list files (default=data/list)')
+    parser.add_argument('-o','--output',  action='store', type=str, default="out", help='Output directory for the offset and zcom files with --keep and the sidecars (default=out)')
+    parser.add_argument('--bands',        action='store', type=str, default=None, help='Optional comma separated list of bands (default=all bands in --listdir)')
+    parser.add_argument('--useTAN',       action='store_true', default=False, required=False, help='Flag to use tan_nwgint variant of input images (for findoff)')
+    parser.add_argument('--keep',         action='store_true', default=False, required=False, help='Also write the findoff (<band>.offset) and fitoff (<band>.zoff) files')
+    parser.add_argument('--noapply',      action='store_true', default=False, required=False, help='Skip the zoff_apply stage')
+    parser.add_argument('--apply_mode',   action='store', type=str, default='rewrite', choices=['rewrite','copy','inplace','sidecar'], help='How zoff_apply applies the offsets (see zoff_apply --mode, default=rewrite; sidecar writes <output>/<band>.sidecar)')
+    parser.add_argument('--workers',      action='store', type=int, default=None, help='Number of bands run at the same time (default=number of cores)')
+    parser.add_argument('--cache_mb',     action='store', type=float, default=2048.0, help='Memory budget (MB) for caching image data between pairs (default=2048, per band)')
+    parser.add_argument('--pairstore',    action='store', type=str, default=None, help='Optional directory of pair measurement stores (<band>.npz), so only changed pairs are measured (see findoff)')
+    parser.add_argument('--catalog',      action='store', type=str, default=None, help='Optional header catalog (.npz) of the image metadata of all bands, created or updated as needed')
+    parser.add_argument('--wcscache',     action='store', type=str, default=None, help='Optional directory to cache the WCS of each image (see findoff)')
+    parser.add_argument('--gridmap',      action='store', type=int, default=None, help='Optional grid spacing (pixels) for an interpolated pixel mapping (see findoff)')
+    parser.add_argument('--median_tol',   action='store', type=float, default=None, help='Optional error bound for a faster histogram median (see findoff)')
+    parser.add_argument('--sample',       action='store', type=float, default=None, help='Optional subsampling of overlap pixels (see findoff)')
+
+    parser.add_argument('-v','--verbose', action='store', type=int, default=0,    required=False, help='Verbosity (default=0, max=2)')
+
+    args = parser.parse_args()
+    if (args.verbose > 0):
+        print("Args: {:}".format(args))
+
+    if (args.bands is None):
+        bands=find_bands(args.listdir)
+    else:
+        bands=args.bands.split(",")
+    print("Found {:d} bands: {:s}".format(len(bands)," ".join(bands)))
+    if (len(bands) == 0):
+        exit(1)
+    if ((args.keep)or(args.apply_mode == 'sidecar')):
+        os.makedirs(args.output,exist_ok=True)
+    if (args.pairstore is not None):
+        os.makedirs(args.pairstore,exist_ok=True)
+
+    opts={'listdir':args.listdir,'outdir':args.output,'useTAN':args.useTAN,'keep':args.keep,'apply':not(args.noapply),'apply_mode':args.apply_mode,
+          'minpix':500,'cache_mb':args.cache_mb,'wcscache':args.wcscache,'pairstore':args.pairstore,'verbose':args.verbose,
+          'mdopts':{'median_tol':args.median_tol,'gridstep':args.gridmap,'sample':args.sample}}
+
+    workers=args.workers
+    if (workers is None):
+        workers=os.cpu_count()
+
+    # one header catalog for the images of all bands, built before the bands start
+    catalog=None
+    if (args.catalog is not None):
+        files=[]
+        for band in bands:
+            flist,_=findoff.read_image_list(os.path.join(args.listdir,"sci.{:s}.list".format(band)),useTAN=args.useTAN)
+            files.extend([os.path.join("data",Img) for Img in flist])
+        catalog=findoff.header_catalog(files,catfile=args.catalog,workers=workers,verbose=args.verbose)
+    opts['catalog']=catalog
+
+    workers=max(1,min(workers,len(bands)))
+    if (workers == 1):
+        summary=[run_band(band,opts) for band in bands]
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            summary=pool.map(_run_band,[(band,opts) for band in bands])
+
+    for band,nimg,npair,dt in summary:
+        print("Band {:s}: {:d} images, {:d} pairs, {:.2f} seconds".format(band,nimg,npair,dt))
+    print("Total execution time: {:.2f} seconds".format(time.time()-t00))
+
+    # Process completed
+    exit(0)
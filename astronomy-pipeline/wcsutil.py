@@ -29,13 +29,19 @@ _license = """
     Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 """
+import hashlib
 import math
+import os
+import pickle
+import re
 import sys
+from fileutil import atomic_write
 
 try:
     import numpy
     from numpy import isscalar
     import scipy.optimize
+    import scipy.interpolate
     from scipy.optimize import leastsq
     have_numpy = True
 except:
@@ -95,6 +101,10 @@ _ap['-TAN-SIP'] = {'name': 'sip',
                    }
 _allowed_units = ['deg']
 
+# header keywords that define the transformation, see WCS.get_hash()
+_hash_keys = re.compile(r'^(z?naxis[12]|crpix[12]|crval[12]|cd[12]_[12]|ctype[12]|cunit[12]|'
+                        r'pvi?[12]_\d+|longpole|latpole|theta0|(a|b|ap|bp)_(\d+_\d+|order))$')
+
 # same mapping for the inverse
 smkeys = list(_scamp_map.keys())
 for item in smkeys:
@@ -131,9 +141,14 @@ class WCS:
     by solving the for the roots of the transformation by default.  This
     is slow, so if you care about speed and not precision you can set
     find=False in sky2image() and it will use a polynomial fit to the inverse,
-    which is calculated if not already in the header.
+    which is calculated (on first use) if not already in the header.
+
+    WCS objects can be pickled; see WCSCache for an on-disk cache keyed by
+    the header.
 
-    The solve is done using scipy.optimize.fsolve
+    The solve is done with a vectorized Newton iteration that uses the
+    analytic jacobian of the forward transform.  Points that do not converge
+    are solved one at a time using scipy.optimize.fsolve
 
     Examples:
         # Use a fits header as initialization to a WCS class and convert
@@ -166,6 +181,12 @@ class WCS:
         # wcs header
         self.SetAngles(longpole, latpole, theta0)
 
+        # compiled distortion polynomials, see _get_poly()
+        self._polys = {}
+
+        # set when the inverse distortion has to be fit, see _ensure_inverse()
+        self._inverse_pending = False
+
         # Now set a bunch more instance attributes from the wcs in a form
         # that is easier to work with
         self.ExtractFromWCS()
@@ -178,6 +199,15 @@ class WCS:
         import pprint
         return pprint.pformat(self.wcs)
 
+    def __getstate__(self):
+        # the compiled polynomials are rebuilt on demand
+        state = self.__dict__.copy()
+        state['_polys'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
     def __getitem__(self, key):
         return self.wcs[key]
     def __setitem__(self, key, val):
@@ -196,7 +226,19 @@ class WCS:
         """
         return self.naxis.copy()
 
-    def get_jacobian(self, x, y, distort=True, step=1.0):
+    def get_hash(self):
+        """
+        get a hash of the header keywords that define the transformation
+        (naxis, crpix, crval, cd, ctype, distortion terms etc.).  Two WCS
+        with the same hash transform coordinates identically.
+
+        returns
+        -------
+        hex digest string
+        """
+        return header_hash(self.wcs)
+
+    def get_jacobian(self, x, y, distort=True, step=1.0, analytic=True):
         """
         Get the elementes of the jacobian matrix at the specified locations
         This method currently assumes the system is ra,dec
@@ -209,7 +251,9 @@ class WCS:
             Use the distortion model if present.  Default is True
         step: float
             Step used for central difference formula, in pixels.  Default is
-            1.0 pixels.
+            1.0 pixels.  Only used when analytic=False
+        analytic: bool, optional
+            Differentiate the transform analytically.  Default is True
 
         returns
         -------
@@ -218,9 +262,13 @@ class WCS:
 
         method
         ------
-        Finite difference
+        Analytic derivatives of the CD matrix, the distortion polynomials
+        and the tangent plane projection, or finite difference
         """
 
+        if analytic:
+            return self._analytic_jacobian(x, y, distort=distort)
+
         fac = 1.0/(2*step)
 
         _, dec = self.image2sky(x, y, distort=distort)
@@ -250,6 +298,62 @@ class WCS:
 
         return dra_dx, dra_dy, ddec_dx, ddec_dy
 
+    def _analytic_jacobian(self, x, y, distort=True):
+        """
+        Jacobian of image x,y to ra,dec from the chain rule, in the same
+        units and sign convention as the finite difference in get_jacobian
+        """
+        x = numpy.array(x, dtype='f8')
+        y = numpy.array(y, dtype='f8')
+
+        up, vp, dudx, dudy, dvdx, dvdy = self._distorted_plane(x, y, distort=distort)
+
+        # tangent plane to unit vector in the native system
+        # p = (-v, u, 1)/s with u,v in radians
+        u = up * d2r
+        v = vp * d2r
+        s = numpy.sqrt(1.0 + u * u + v * v)
+        p0 = -v / s
+        p1 = u / s
+        p2 = 1.0 / s
+
+        # derivatives of p with respect to u and v
+        fu = u / (s * s)
+        fv = v / (s * s)
+        dp_du = (-p0 * fu, 1.0 / s - p1 * fu, -p2 * fu)
+        dp_dv = (-1.0 / s - p0 * fv, -p1 * fv, -p2 * fv)
+
+        # rotate to the standard system, b = R p
+        r = self.rotation_matrix
+        b = [r[k, 0] * p0 + r[k, 1] * p1 + r[k, 2] * p2 for k in range(3)]
+        db_du = [r[k, 0] * dp_du[0] + r[k, 1] * dp_du[1] + r[k, 2] * dp_du[2]
+                 for k in range(3)]
+        db_dv = [r[k, 0] * dp_dv[0] + r[k, 1] * dp_dv[1] + r[k, 2] * dp_dv[2]
+                 for k in range(3)]
+
+        rho2 = b[0] * b[0] + b[1] * b[1]
+        rho = numpy.sqrt(rho2)
+        dlon_du = (b[0] * db_du[1] - b[1] * db_du[0]) / rho2
+        dlon_dv = (b[0] * db_dv[1] - b[1] * db_dv[0]) / rho2
+        dlat_du = db_du[2] / rho
+        dlat_dv = db_dv[2] / rho
+
+        # u,v are in degrees so the d2r above and r2d here cancel
+        dra_dx = dlon_du * dudx + dlon_dv * dvdx
+        dra_dy = dlon_du * dudy + dlon_dv * dvdy
+        ddec_dx = dlat_du * dudx + dlat_dv * dvdx
+        ddec_dy = dlat_du * dudy + dlat_dv * dvdy
+
+        # in arcsec/pixel, need to scale dra b -cos(dec), minus sign since
+        # ra increases to the left
+        cosdec = -rho
+        dra_dx = 3600.0 * cosdec * dra_dx
+        dra_dy = 3600.0 * cosdec * dra_dy
+        ddec_dx = 3600.0 * ddec_dx
+        ddec_dy = 3600.0 * ddec_dy
+
+        return dra_dx, dra_dy, ddec_dx, ddec_dy
+
     def image2sky(self, x, y, distort=True):
         """
         Convert between image x,y and sky coordinates lon,lat e.g. ra,dec.
@@ -303,7 +407,8 @@ class WCS:
 
         return longitude, latitude
 
-    def sky2image(self, lon, lat, distort=True, find=True, xtol=DEFTOL):
+    def sky2image(self, lon, lat, distort=True, find=True, xtol=DEFTOL,
+                  method='newton'):
         """
         Usage:
             x,y=sky2image(longitude, latitude, distort=True, find=True)
@@ -319,6 +424,10 @@ class WCS:
                 roots of the polynomial rather than using an inverse
                 polynomial.  This is more accurate but slower. Default True.
             xtol: tolerance to use when root finding with find=True Default is 1e-8.
+            method: root finder used with find=True.  'newton' solves all
+                points at once and falls back to fsolve for points that do
+                not converge, 'fsolve' solves each point with fsolve.
+                Default is 'newton'.
         Outputs:
             x,y: x and y coords in the image.  Will have the same shape as
                 lon,lat
@@ -335,7 +444,7 @@ class WCS:
 
         # Only do this if there is distortion
         if find and self.distort['name'] != 'none':
-            x, y = self._findxy(longitude, latitude, xtol=xtol)
+            x, y = self._findxy(longitude, latitude, xtol=xtol, method=method)
         else:
             u, v = self.sph2image(longitude, latitude)
 
@@ -552,13 +661,16 @@ class WCS:
             raise RuntimeError("failed to find inverse transform: '%s'" % errmsg)
         return xy
 
-    def _findxy(self, lon, lat, xtol=DEFTOL):
+    def _findxy(self, lon, lat, xtol=DEFTOL, method='newton'):
         """
         This is the simplest way to do the inverse of the (x,y)->(lon,lat)
         transformation when there are distortions.  Simply find the x,y
         that give the input lon,lat from the actual distortion function.
 
-        Uses scipy.optimize.fsolve to find the roots of the transformation
+        With method='newton' all points are solved at once using
+        _findxy_newton and only the points that fail to converge are
+        passed on to scipy.optimize.fsolve.  With method='fsolve' every
+        point is solved with scipy.optimize.fsolve
         """
 
         if lon.size != lat.size:
@@ -566,15 +678,133 @@ class WCS:
 
         if isscalar(lon):
             x, y = self._findxy_one(lon, lat, xtol=xtol)
-        else:
+        elif method == 'newton':
+            x, y, converged = self._findxy_newton(lon, lat, xtol=xtol)
+            w, = numpy.where(~converged)
+            for i in w:
+                x[i], y[i] = self._findxy_one(lon[i], lat[i], xtol=xtol)
+        elif method == 'fsolve':
             x = numpy.zeros_like(lon)
             y = numpy.zeros_like(lon)
 
             for i in range(lon.size):
                 x[i], y[i] = self._findxy_one(lon[i], lat[i], xtol=xtol)
+        else:
+            raise ValueError(f"method '{method}' not supported")
 
         return x, y
 
+    def _findxy_newton(self, lon, lat, xtol=DEFTOL, maxiter=20):
+        """
+        Vectorized inverse of the (x,y)->(lon,lat) transformation.
+
+        The sky positions are projected onto the tangent plane, which is
+        exact, and the distortion model is then inverted there with a
+        Newton iteration over the whole array using the analytic jacobian
+        of the CD+distortion forward model.  A point is converged when the
+        length of its last step is at most xtol times the length of (x,y)
+        (or xtol pixels when (x,y) is within a pixel of the origin), which
+        mirrors the relative xtol test of scipy.optimize.fsolve.
+
+        parameters
+        ----------
+        lon,lat: arrays
+            sky coordinates, probably ra,dec
+        xtol: float, optional
+            relative tolerance on x,y.  Default is 1e-8
+        maxiter: int, optional
+            maximum number of Newton steps.  Default is 20
+
+        returns
+        -------
+        x, y, converged: tuple of arrays
+            converged is a bool array that is False for points that did not
+            meet the tolerance within maxiter steps
+        """
+
+        tu, tv = self.sph2image(lon, lat)
+
+        # Use inversion without distortion as our guess
+        xdiff, ydiff = self.ApplyCDMatrix(tu, tv, inverse=True)
+        x = xdiff + self.crpix[0]
+        y = ydiff + self.crpix[1]
+
+        converged = numpy.zeros(x.size, dtype=bool)
+        active = numpy.arange(x.size)
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            for _ in range(maxiter):
+                xa = x[active]
+                ya = y[active]
+                up, vp, dudx, dudy, dvdx, dvdy = self._distorted_plane(xa, ya)
+                fu = up - tu[active]
+                fv = vp - tv[active]
+
+                det = dudx * dvdy - dudy * dvdx
+                dx = (dvdy * fu - dudy * fv) / det
+                dy = (dudx * fv - dvdx * fu) / det
+                xa -= dx
+                ya -= dy
+                x[active] = xa
+                y[active] = ya
+
+                step = numpy.hypot(dx, dy)
+                done = step <= xtol * numpy.maximum(numpy.hypot(xa, ya), 1.0)
+                converged[active[done]] = True
+
+                # points with a singular jacobian are left for the fallback
+                keep = ~done & numpy.isfinite(step)
+                active = active[keep]
+                if active.size == 0:
+                    break
+
+        return x, y, converged
+
+    def _distorted_plane(self, x, y, distort=True):
+        """
+        Forward model from image x,y to the (distorted) tangent plane
+        coordinates u,v in degrees, together with the analytic jacobian.
+
+        returns
+        -------
+        u, v, du/dx, du/dy, dv/dx, dv/dy
+        """
+        xdiff = x - self.crpix[0]
+        ydiff = y - self.crpix[1]
+        cd = self.cd
+
+        if not distort or self.distort['name'] == 'none':
+            u, v = self.ApplyCDMatrix(xdiff, ydiff)
+            ones = numpy.ones_like(u)
+            return (u, v, cd[0, 0] * ones, cd[0, 1] * ones,
+                    cd[1, 0] * ones, cd[1, 1] * ones)
+
+        if self.distort['name'] == 'scamp':
+            # PV distortions come after the CD matrix
+            u, v = self.ApplyCDMatrix(xdiff, ydiff)
+            up, dadu, dadv = self._get_poly('a')(u, v, deriv=True)
+            vp, dbdu, dbdv = self._get_poly('b')(u, v, deriv=True)
+            dudx = dadu * cd[0, 0] + dadv * cd[1, 0]
+            dudy = dadu * cd[0, 1] + dadv * cd[1, 1]
+            dvdx = dbdu * cd[0, 0] + dbdv * cd[1, 0]
+            dvdy = dbdu * cd[0, 1] + dbdv * cd[1, 1]
+            return up, vp, dudx, dudy, dvdx, dvdy
+
+        if self.distort['name'] == 'sip':      # pragma: no cover
+            # SIP distortions come before the CD matrix
+            da, dadx, dady = self._get_poly('a')(xdiff, ydiff, deriv=True)
+            db, dbdx, dbdy = self._get_poly('b')(xdiff, ydiff, deriv=True)
+            up, vp = self.ApplyCDMatrix(xdiff + da, ydiff + db)
+            dadx += 1.0
+            dbdy += 1.0
+            dudx = cd[0, 0] * dadx + cd[0, 1] * dbdx
+            dudy = cd[0, 0] * dady + cd[0, 1] * dbdy
+            dvdx = cd[1, 0] * dadx + cd[1, 1] * dbdx
+            dvdy = cd[1, 0] * dady + cd[1, 1] * dbdy
+            return up, vp, dudx, dudy, dvdx, dvdy
+
+        raise ValueError(f"Unsupported distortion model '{self.distort['name']}'")      # pragma: no cover
+
     def _findxy_one(self, lon, lat, xtol=DEFTOL):
         """
         This is the simplest way to do the inverse of the (x,y)->(lon,lat)
@@ -597,6 +827,19 @@ class WCS:
 
         return x, y
 
+    def _get_poly(self, key):
+        """
+        Get the compiled Poly2D for one of the distortion matrices
+        ('a', 'b', 'ap' or 'bp').  It is rebuilt if the matrix has been
+        replaced, e.g. by InvertDistortion()
+        """
+        a = self.distort[key]
+        poly = self._polys.get(key)
+        if poly is None or poly.a is not a:
+            poly = Poly2D(a)
+            self._polys[key] = poly
+        return poly
+
     def Distort(self, x, y, inverse=False):
         """
         Apply a distortion map to the data.  This follows the SIP convention,
@@ -615,11 +858,12 @@ class WCS:
             raise ValueError('x must be same size as y')
 
         if inverse:
-            a = self.distort['ap']
-            b = self.distort['bp']
+            self._ensure_inverse()
+            a = self._get_poly('ap')
+            b = self._get_poly('bp')
         else:
-            a = self.distort['a']
-            b = self.distort['b']
+            a = self._get_poly('a')
+            b = self._get_poly('b')
 
         if self.distort['name'] == 'scamp':
             xp = 0 * x
@@ -630,12 +874,23 @@ class WCS:
         else:      # pragma: no cover
             raise ValueError(f"Unsupported distortion model '{self.distort['name']}'")
 
-        xp += Apply2DPolynomial(a, x, y)
-        yp += Apply2DPolynomial(b, x, y)
+        xp += a(x, y)
+        yp += b(x, y)
 
         return xp, yp
 
 
+    def _ensure_inverse(self):
+        """
+        Fit the inverse distortion polynomials if the header did not
+        provide them.  This is put off until the inverse polynomial is first
+        needed (sky2image with find=False), since the default root finding
+        never uses it
+        """
+        if self._inverse_pending:
+            self._inverse_pending = False
+            self.InvertDistortion()
+
     def _compare_inversion(self, x, y, xback, yback,
                            verbose=False, doplot=False, units=''):
         # Get rms differences
@@ -694,8 +949,8 @@ class WCS:
 
         # This is what we will invert
         #up,vp = self.Distort(u,v)
-        up = Apply2DPolynomial(self.distort['a'], u, v)
-        vp = Apply2DPolynomial(self.distort['b'], u, v)
+        up = self._get_poly('a')(u, v)
+        vp = self._get_poly('b')(u, v)
 
 
 
@@ -705,8 +960,8 @@ class WCS:
         self.distort['bp'] = binv
 
         #newu, newv = self.Distort(up, vp, inverse=True)
-        newu = Apply2DPolynomial(ainv, up, vp)
-        newv = Apply2DPolynomial(binv, up, vp)
+        newu = self._get_poly('ap')(up, vp)
+        newv = self._get_poly('bp')(up, vp)
         ufrac = (u - newu) / u
         vfrac = (v - newv) / v
         if verbose:      # pragma: no cover
@@ -881,44 +1136,7 @@ class WCS:
         self.projection = None
 
         # Convert the wcs to a local dictionary
-
-        wcs = {}
-        if isinstance(wcs_in, numpy.ndarray) or hasattr(wcs_in, 'dtype'):
-            if wcs_in.dtype.fields is None:
-                raise ValueError('wcs array must have fields')
-
-            for f in wcs_in.dtype.fields:
-                fl = f.lower()
-                val = wcs_in[f]
-                if val.ndim == 0:
-                    wcs[fl] = val
-                else:
-                    # only scalars
-                    wcs[fl] = val[0]
-
-        elif isinstance(wcs_in, dict):
-            wcs = wcs_in.copy()
-        elif hasattr(wcs_in, '__iter__'):
-            wcs = {}
-            for k in wcs_in:
-                if k is None:
-                    continue
-                wcs[k.lower()] = wcs_in[k]
-        else:
-            # Try to use the items() method to get what we want
-            wcs = {}
-            try:
-                for k, v in wcs_in.items():
-                    if k is None:
-                        continue
-                    wcs[k.lower()] = v
-            except:
-                raise ValueError('Input wcs must be a numpy array '+
-                                 'with fields or a dictionary or support '+
-                                 'iteration or an items() method')
-
-
-        return wcs
+        return header_dict(wcs_in)
 
 
     def SetAngles(self, longpole, latpole, theta0):
@@ -1021,9 +1239,9 @@ class WCS:
             self.distort['bp'] = bp
             self.distort['bp_order'] = bporder
 
-            # If inverse not there, calculate it
+            # If inverse not there, calculate it when first needed
             if cap == 0 or cbp == 0:
-                self.InvertDistortion()
+                self._inverse_pending = True
                 self.distort['ap_order'] = self.distort['a_order'] + 1
                 self.distort['bp_order'] = self.distort['b_order'] + 1
 
@@ -1096,6 +1314,289 @@ class WCS:
         else:
             self.naxis = numpy.array([wcs['naxis1'], wcs['naxis2']])
 
+def header_dict(wcs_in):
+    """
+    Convert a header (numpy array with fields, dictionary, fitsio header or
+    anything with an items() method) to a dictionary with lower case keys
+    """
+    wcs = {}
+    if isinstance(wcs_in, numpy.ndarray) or hasattr(wcs_in, 'dtype'):
+        if wcs_in.dtype.fields is None:
+            raise ValueError('wcs array must have fields')
+
+        for f in wcs_in.dtype.fields:
+            fl = f.lower()
+            val = wcs_in[f]
+            if val.ndim == 0:
+                wcs[fl] = val
+            else:
+                # only scalars
+                wcs[fl] = val[0]
+
+    elif isinstance(wcs_in, dict):
+        wcs = wcs_in.copy()
+    elif hasattr(wcs_in, '__iter__'):
+        wcs = {}
+        for k in wcs_in:
+            if k is None:
+                continue
+            wcs[k.lower()] = wcs_in[k]
+    else:
+        # Try to use the items() method to get what we want
+        wcs = {}
+        try:
+            for k, v in wcs_in.items():
+                if k is None:
+                    continue
+                wcs[k.lower()] = v
+        except:
+            raise ValueError('Input wcs must be a numpy array '+
+                             'with fields or a dictionary or support '+
+                             'iteration or an items() method')
+
+    return wcs
+
+
+def header_hash(wcs):
+    """
+    Hash of the keywords of a header dictionary (see header_dict) that
+    define the transformation (naxis, crpix, crval, cd, ctype, distortion
+    terms etc.).  Two WCS with the same hash transform coordinates
+    identically.
+
+    returns
+    -------
+    hex digest string
+    """
+    h = hashlib.sha1()
+    for key in sorted(wcs.keys()):
+        if _hash_keys.match(key):
+            val = wcs[key]
+            if isinstance(val, str):
+                val = val.strip().upper()
+            h.update(f'{key}={val!r};'.encode())
+    return h.hexdigest()
+
+
+class WCSCache:
+    """
+    On-disk cache of WCS objects, keyed by the hash of the header (see
+    header_hash) and the pole/theta0 arguments.  Each WCS is pickled to its
+    own file, so building the WCS of an image seen before is a fast load
+    and the inverse distortion fit is only ever done once per header.
+
+    Usage:
+        cache = WCSCache(cachedir)
+        wcs = cache.get(hdr)
+
+    parameters
+    ----------
+    cachedir: string
+        directory holding the cached WCS (created if needed)
+    invert: bool, optional
+        fit the inverse distortion (if the header has none) before storing
+        a new WCS, so loaded objects never need it.  Default is True
+    """
+    # bump when the layout of the WCS class changes, so old files are ignored
+    version = 1
+
+    def __init__(self, cachedir, invert=True):
+        self.cachedir = cachedir
+        self.invert = invert
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cachedir, exist_ok=True)
+
+    def key(self, wcs, longpole=180.0, latpole=90.0, theta0=90.0):
+        h = hashlib.sha1()
+        h.update(f'{self.version};{header_hash(wcs)};'
+                 f'{longpole!r};{latpole!r};{theta0!r}'.encode())
+        return h.hexdigest()
+
+    def get(self, hdr, longpole=180.0, latpole=90.0, theta0=90.0):
+        """
+        get the WCS for a header, loading it from the cache or building
+        (and storing) it
+        """
+        wcs = header_dict(hdr)
+        fname = os.path.join(self.cachedir,
+                             self.key(wcs, longpole, latpole, theta0) + '.pkl')
+        if os.path.isfile(fname):
+            try:
+                with open(fname, 'rb') as f:
+                    obj = pickle.load(f)
+                self.hits += 1
+                return obj
+            except Exception:
+                # unreadable (e.g. written by another version), rebuild
+                pass
+
+        self.misses += 1
+        obj = WCS(wcs, longpole=longpole, latpole=latpole, theta0=theta0)
+        if self.invert:
+            obj._ensure_inverse()
+
+        with atomic_write(fname, suffix='.pkl') as tname:
+            with open(tname, 'wb') as f:
+                pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return obj
+
+
+class PixelMapper:
+    """
+    Map image coordinates of one WCS onto the image coordinates of another
+    by interpolation.
+
+    The exact transform (image2sky of the first WCS followed by sky2image of
+    the second) is computed on a grid of nodes every `step` pixels and
+    interpolated with bicubic splines.  The mapping between two tangent
+    plane images is smooth, so this is accurate to a small fraction of a
+    pixel at a tiny fraction of the cost of the exact transform.  The
+    interpolation error is measured against the exact transform at the
+    centres of the grid cells, where it is largest; while it exceeds tol
+    the grid spacing is halved (down to minstep).
+
+    Usage:
+        mapper = PixelMapper(wcs1, wcs2, step=64, tol=0.01)
+        x2, y2 = mapper(x1, y1)
+        mapper.maxerr   # measured maximum error in pixels
+
+    parameters
+    ----------
+    wcs_from, wcs_to: WCS
+        transform from the image of wcs_from to the image of wcs_to
+    step: int, optional
+        initial grid spacing in pixels.  Default is 64
+    tol: float, optional
+        maximum interpolation error in pixels.  Default is 0.01
+    xrange, yrange: sequences, optional
+        range of input coordinates to cover.  Default is [0, naxis] of
+        wcs_from
+    minstep: int, optional
+        smallest grid spacing tried.  Default is 4
+    ncheck: int, optional
+        maximum number of cell centres used to check the error.  Default
+        is 2000
+    """
+    def __init__(self, wcs_from, wcs_to, step=64, tol=0.01,
+                 xrange=None, yrange=None, minstep=4, ncheck=2000):
+        self.wcs_from = wcs_from
+        self.wcs_to = wcs_to
+        self.tol = tol
+
+        if xrange is None:
+            xrange = [0.0, float(wcs_from.naxis[0])]
+        if yrange is None:
+            yrange = [0.0, float(wcs_from.naxis[1])]
+        self.xrange = xrange
+        self.yrange = yrange
+
+        self.step = step
+        while True:
+            self._build(self.step)
+            self.maxerr = self._check(ncheck)
+            if self.maxerr <= tol or self.step <= minstep:
+                break
+            self.step = max(self.step // 2, minstep)
+
+        self.converged = self.maxerr <= tol
+
+    def _exact(self, x, y):
+        lon, lat = self.wcs_from.image2sky(x, y)
+        return self.wcs_to.sky2image(lon, lat)
+
+    def _build(self, step):
+        """
+        compute the exact transform on the grid nodes and set up the splines
+        """
+        # at least 4 nodes per axis for a cubic spline
+        nx = max(int(numpy.ceil((self.xrange[1] - self.xrange[0]) / step)) + 1, 4)
+        ny = max(int(numpy.ceil((self.yrange[1] - self.yrange[0]) / step)) + 1, 4)
+        self.xnodes = numpy.linspace(self.xrange[0], self.xrange[1], nx)
+        self.ynodes = numpy.linspace(self.yrange[0], self.yrange[1], ny)
+
+        xg, yg = numpy.meshgrid(self.xnodes, self.ynodes, indexing='ij')
+        xt, yt = self._exact(xg.ravel(), yg.ravel())
+
+        self._xspline = scipy.interpolate.RectBivariateSpline(
+            self.xnodes, self.ynodes, xt.reshape(nx, ny), kx=3, ky=3)
+        self._yspline = scipy.interpolate.RectBivariateSpline(
+            self.xnodes, self.ynodes, yt.reshape(nx, ny), kx=3, ky=3)
+
+    def _check(self, ncheck):
+        """
+        maximum interpolation error (pixels) at the cell centres
+        """
+        xc = 0.5 * (self.xnodes[1:] + self.xnodes[:-1])
+        yc = 0.5 * (self.ynodes[1:] + self.ynodes[:-1])
+        xc, yc = numpy.meshgrid(xc, yc, indexing='ij')
+        xc = xc.ravel()
+        yc = yc.ravel()
+        if xc.size > ncheck:
+            # evenly spaced subset, always including the corner cells
+            w = numpy.unique(numpy.linspace(0, xc.size - 1, ncheck).astype(int))
+            xc = xc[w]
+            yc = yc[w]
+
+        xt, yt = self._exact(xc, yc)
+        xi, yi = self(xc, yc)
+        return numpy.hypot(xi - xt, yi - yt).max()
+
+    def __call__(self, x, y):
+        """
+        interpolated image coordinates in wcs_to of the points x,y in
+        wcs_from.  Returns arrays with the same shape as x,y
+
+        When the points are whole pixels that fill much of their bounding
+        box (the usual case for images) the splines are evaluated on that
+        pixel grid, which is separable and much faster, and the points are
+        picked out of it.
+        """
+        x = numpy.asarray(x)
+        y = numpy.asarray(y)
+
+        if x.size >= 16:
+            x0, x1 = x.min(), x.max()
+            y0, y1 = y.min(), y.max()
+            area = (x1 - x0 + 1) * (y1 - y0 + 1)
+            if area <= 4 * x.size:
+                whole = x.dtype.kind in 'iu' and y.dtype.kind in 'iu'
+                if not whole:
+                    whole = (numpy.array_equal(x, numpy.rint(x)) and
+                             numpy.array_equal(y, numpy.rint(y)))
+                if whole:
+                    xg, yg = self.grid(numpy.arange(x0, x1 + 1), numpy.arange(y0, y1 + 1))
+                    ix = (x - x0).astype(numpy.intp)
+                    iy = (y - y0).astype(numpy.intp)
+                    return xg[iy, ix], yg[iy, ix]
+
+        x = x.astype('f8')
+        y = y.astype('f8')
+        return self._xspline.ev(x, y), self._yspline.ev(x, y)
+
+    def grid(self, x, y):
+        """
+        interpolated image coordinates in wcs_to on the grid of points
+        made from the 1-d arrays x and y.  Returns two arrays of shape
+        (len(y), len(x)), i.e. indexed [y, x] like an image
+        """
+        x = numpy.asarray(x, dtype='f8')
+        y = numpy.asarray(y, dtype='f8')
+
+        # The tensor product spline on a grid is By C Bx^T with the
+        # B-spline design matrices Bx, By and coefficient matrix C
+        tx, ty = self._xspline.get_knots()
+        bx = scipy.interpolate.BSpline.design_matrix(x, tx, 3, extrapolate=True).toarray()
+        by = scipy.interpolate.BSpline.design_matrix(y, ty, 3, extrapolate=True).toarray()
+        nc = (tx.size - 4, ty.size - 4)
+
+        out = []
+        for spline in (self._xspline, self._yspline):
+            c = spline.get_coeffs().reshape(nc)
+            out.append((by @ c.T) @ bx.T)
+        return out[0], out[1]
+
+
 def _dict_get(d, key, default=None):
     if key not in d:
         if default is not None:
@@ -1132,19 +1633,109 @@ def arrscl(arr, minval, maxval, arrmin=None, arrmax=None):
 
     return output
 
+class Poly2D:
+    """
+    A 2D polynomial v = sum a[ix, iy] x**ix y**iy compiled once from its
+    coefficient matrix.
+
+    Zero coefficients are dropped when the object is made.  Each call builds
+    a table of the powers of y once, forms the row polynomials
+    q_ix(y) = sum a[ix, iy] y**iy from the non-zero terms only and combines
+    the rows in Horner form in x.  The partial derivatives are available
+    analytically with deriv=True.
+
+    Usage:
+        poly = Poly2D(a)
+        v = poly(x, y)
+        v, dvdx, dvdy = poly(x, y, deriv=True)
+    """
+    def __init__(self, a):
+        self.a = a
+        coeffs = numpy.array(a, dtype='f8')
+
+        # non-zero terms of each row as (iy, coeff), highest x power last
+        self.rows = []
+        for ix in range(coeffs.shape[0]):
+            iy, = numpy.nonzero(coeffs[ix])
+            self.rows.append([(int(j), float(coeffs[ix, j])) for j in iy])
+
+        # drop empty high order rows so Horner starts at the first used one
+        while self.rows and not self.rows[-1]:
+            self.rows.pop()
+
+        self.ymax = max([t[-1][0] for t in self.rows if t], default=0)
+
+    def __call__(self, x, y, deriv=False):
+        x = numpy.asarray(x)
+        y = numpy.asarray(y)
+        shape = numpy.broadcast(x, y).shape
+        dtype = numpy.result_type(x, y, 'f8')
+
+        if not self.rows:
+            zero = numpy.zeros(shape, dtype=dtype)
+            if deriv:
+                return zero, zero.copy(), zero.copy()
+            return zero
+
+        # powers of y, built once per call
+        ypow = [None] * (self.ymax + 1)
+        if self.ymax > 0:
+            ypow[1] = y
+        for k in range(2, self.ymax + 1):
+            ypow[k] = ypow[k - 1] * y
+
+        q = [self._row(terms, ypow, shape, dtype) for terms in self.rows]
+        v = self._horner(q, x)
+        if not deriv:
+            return v
+
+        dq = [self._row(terms, ypow, shape, dtype, deriv=True)
+              for terms in self.rows]
+        dvdx = self._horner([ix * qi for ix, qi in enumerate(q)][1:], x,
+                            shape, dtype)
+        dvdy = self._horner(dq, x, shape, dtype)
+        return v, dvdx, dvdy
+
+    @staticmethod
+    def _row(terms, ypow, shape, dtype, deriv=False):
+        """
+        Sum the non-zero terms of one row, or of its y derivative
+        """
+        q = numpy.zeros(shape, dtype=dtype)
+        for iy, c in terms:
+            if deriv:
+                if iy == 0:
+                    continue
+                c, iy = iy * c, iy - 1
+            if iy == 0:
+                q += c
+            else:
+                q += c * ypow[iy]
+        return q
+
+    @staticmethod
+    def _horner(q, x, shape=None, dtype='f8'):
+        """
+        Combine the row polynomials q[ix] into sum q[ix] x**ix
+        """
+        if not q:
+            return numpy.zeros(shape, dtype=dtype)
+        v = numpy.array(q[-1], dtype=dtype)
+        for qi in q[-2::-1]:
+            v *= x
+            v += qi
+        return v
+
+
 def Apply2DPolynomial(a, x, y):
-    v = numpy.zeros_like(x)
-
-    sx, sy = a.shape
-    for ix in range(sx):
-        for iy in range(sy):
-            xpow = x ** ix
-            ypow = y ** iy
-            if a[ix, iy] != 0.0:
-                addval = a[ix, iy] * xpow * ypow
-                v += addval
-
-    return v
+    return Poly2D(a)(x, y)
+
+def Apply2DPolynomialDeriv(a, x, y):
+    """
+    Evaluate the polynomial and its partial derivatives with respect to
+    x and y.  Returns v, dv/dx, dv/dy
+    """
+    return Poly2D(a)(x, y, deriv=True)
 
 def make_xy_grid(n, xrang, yrang):
     # Create a grid on input ranges
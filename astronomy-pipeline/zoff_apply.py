@@ -5,10 +5,16 @@
 import os
 import argparse
 import re
+import shutil
 import time
+import multiprocessing
 import fitsio
+from fileutil import atomic_write
 import numpy as np
 
+# the fitted offsets (fitoff) are OFFSET_SCALE times the offset added to the SCI pixels of the coadd_nwgint images
+OFFSET_SCALE=64.
+
 
 ###########################################
 def get_data(file,verbose=0):
@@ -28,6 +34,225 @@ def get_data(file,verbose=0):
     return ih, isci, iwh, iwgt, iwh2, iwgt2, imh, imsk
   
 
+###########################################
+def block_rows(hdu,maxbytes=256*1024**2):
+    """Number of rows per block of a 2D image HDU for about maxbytes per block (whole rows of tiles for tile compressed images)
+    """
+    rows=max(1,int(maxbytes//(8*hdu.get_dims()[1])))
+    if (hdu.is_compressed()):
+        tile=int(hdu.read_header().get('ZTILE2',1))
+        rows=max(tile,(rows//tile)*tile)
+    return rows
+
+
+###########################################
+def add_offset_rows(hdu,offval,maxbytes=256*1024**2):
+    """Add offval to an (open, read-write) image HDU a block of rows at a time, so that at most about maxbytes of it are in memory.
+    For tile compressed images the blocks are whole rows of tiles, so each tile is decompressed and recompressed once.
+    """
+    dims=hdu.get_dims()
+    if (len(dims) != 2):
+        hdu.write(hdu.read()+offval)
+        return
+    nrow=dims[0]
+    rows=block_rows(hdu,maxbytes)
+    for r0 in range(0,nrow,rows):
+        r1=min(r0+rows,nrow)
+        hdu.write(hdu[r0:r1,:]+offval,start=[r0,0])
+
+
+###########################################
+def is_applied(oname,offval,mode):
+    """Check whether oname already holds the result of applying offval (so a restarted run can skip it).
+    An image changed in place can not be changed again: a different recorded offset, or an interrupted in place
+    update (ZOFFPND without ZOFFAPP) of another offset, raises a ValueError.  An interrupted in place update of
+    the same offset is not applied yet, so it is resumed (see apply_inplace).
+    """
+    if (not(os.path.isfile(oname))):
+        return False
+    try:
+        ih=fitsio.read_header(oname,ext='SCI')
+    except (IOError,OSError,ValueError):
+        if (mode == 'inplace'):
+            raise
+        return False
+    tol=1.0e-9*max(1.0,abs(offval))
+    if ('ZOFFAPP' not in ih):
+        if ((mode == 'inplace')and('ZOFFPND' in ih)and(abs(ih['ZOFFPND']-offval) > tol)):
+            raise ValueError("{:s}: an earlier in place update with offset {:g} was interrupted; rerun it with that offset to finish it before applying {:g}".format(oname,ih['ZOFFPND'],offval))
+        return False
+    if (abs(ih['ZOFFAPP']-offval) <= tol):
+        return True
+    if (mode == 'inplace'):
+        raise ValueError("{:s}: offset {:g} was already applied in place, not {:g}; restore the original image to apply the new offset".format(oname,ih['ZOFFAPP'],offval))
+    return False
+
+
+###########################################
+def apply_offset(file,offval,mode='rewrite',maxbytes=256*1024**2,verbose=0):
+    """Add offval to the SCI image of file.
+    mode='rewrite' writes all four HDUs (decoded and re-encoded) to the matching _hack.fits file.
+    mode='copy' copies file byte for byte to the _hack.fits file and then updates only its SCI HDU (in blocks of rows of about maxbytes).
+    mode='inplace' updates the SCI HDU of file itself in the same way (only SCI is read and written, see apply_inplace).
+    For rewrite and copy the result is written to a temporary file and renamed, so a file is either untouched or complete.
+    In place, an interrupted update is resumed from the last finished block of rows by the next run.
+    The offset is recorded in the SCI header (ZOFFAPP) and a file that already holds the result is not redone
+    (an image changed in place with another offset, or left half done, is an error, see is_applied).
+    Returns the name of the file holding the result and whether it was written (False if it was skipped).
+    """
+    if (mode == 'inplace'):
+        oname=file
+    elif ((mode == 'rewrite')or(mode == 'copy')):
+        oname=re.sub(".fits","_hack.fits",file)
+    else:
+        raise ValueError("Unknown mode '{:s}'".format(mode))
+
+    if (is_applied(oname,offval,mode)):
+        if (verbose > 0):
+            print("Offset already applied to {:s}".format(oname))
+        return oname,False
+
+    if (mode == 'inplace'):
+        apply_inplace(file,offval,maxbytes=maxbytes,verbose=verbose)
+        return oname,True
+
+    with atomic_write(oname,suffix=".fits") as tname:
+        if (mode == 'rewrite'):
+            ih, isci, iwh, iwgt, iwh2, iwgt2, imh, imsk = get_data(file,verbose=verbose)
+            isci=isci+offval
+
+            ofits = fitsio.FITS(tname,'rw',clobber=True)
+            ofits.write(isci,header=ih,extname='SCI')
+            ofits.write(iwgt,header=iwh,extname='WGT')
+            ofits.write(iwgt2,header=iwh2,extname='WGT_ME')
+            ofits.write(imsk,header=imh,extname='MSK')
+        else:
+            shutil.copyfile(file,tname)
+            ofits=fitsio.FITS(tname,'rw')
+            add_offset_rows(ofits['SCI'],offval,maxbytes=maxbytes)
+        ofits['SCI'].write_key('ZOFFAPP',offval,comment='Offset added by zoff_apply')
+        ofits.close()
+    return oname,True
+
+
+###########################################
+def apply_inplace(file,offval,maxbytes=256*1024**2,verbose=0):
+    """Add offval to the SCI image of file in place, a block of rows (of about maxbytes) at a time, so that an
+    interrupted update can be resumed.  The SCI header records the offset being added (ZOFFPND) and the number of
+    rows already done (ZOFFROW, updated after each block).  The original rows of a block are saved to
+    <file>.zoffblk.npz before it is changed, so a block that was being written when the run stopped is redone
+    from its original values instead of getting the offset twice.  The completion marker (ZOFFAPP) is written last.
+    """
+    bname=file+".zoffblk.npz"
+    ofits=fitsio.FITS(file,'rw')
+    hdu=ofits['SCI']
+    ih=hdu.read_header()
+    dims=hdu.get_dims()
+    if ('ZOFFPND' in ih):
+        r0=int(ih.get('ZOFFROW',0))
+        if (verbose > 0):
+            print("Resuming the update of {:s} at row {:d}".format(file,r0))
+    else:
+        hdu.write_key('ZOFFPND',offval,comment='Offset being added by zoff_apply')
+        hdu.write_key('ZOFFROW',0,comment='Rows done by zoff_apply')
+        r0=0
+    # an image that is not 2D is a single block
+    if (len(dims) == 2):
+        nrow=dims[0]
+        rows=block_rows(hdu,maxbytes)
+    else:
+        nrow=1
+        rows=1
+    ofits.close()
+
+    b0=r0
+    while (b0 < nrow):
+        b1=min(b0+rows,nrow)
+        # the saved original of the block being written when an earlier run stopped (that block may be of another size)
+        orig=None
+        if (os.path.isfile(bname)):
+            with np.load(bname) as npz:
+                if (int(npz['start']) == b0):
+                    orig=npz['data']
+                    if (len(dims) == 2):
+                        b1=b0+orig.shape[0]
+        ofits=fitsio.FITS(file,'rw')
+        hdu=ofits['SCI']
+        if (orig is None):
+            orig=hdu[b0:b1,:] if (len(dims) == 2) else hdu.read()
+            with atomic_write(bname,suffix=".npz") as tname:
+                np.savez(tname,start=b0,data=orig)
+        if (len(dims) == 2):
+            hdu.write(orig+offval,start=[b0,0])
+        else:
+            hdu.write(orig+offval)
+        ofits.close()
+        ofits=fitsio.FITS(file,'rw')
+        ofits['SCI'].write_key('ZOFFROW',b1,comment='Rows done by zoff_apply')
+        ofits.close()
+        b0=b1
+
+    # completion marker, after the data are on disk
+    ofits=fitsio.FITS(file,'rw')
+    ofits['SCI'].write_key('ZOFFAPP',offval,comment='Offset added by zoff_apply')
+    ofits['SCI'].delete_key('ZOFFPND')
+    ofits['SCI'].delete_key('ZOFFROW')
+    ofits.close()
+    if (os.path.isfile(bname)):
+        os.remove(bname)
+
+
+###########################################
+def _apply_task(task):
+    """Worker for the process pool: task is (file, offval, mode, maxbytes), returns (file, input size in bytes, written, error message or None)
+    """
+    file,offval,mode,maxbytes=task
+    # an unreadable image or a full disk only fails this image, the others are still done (and reported)
+    try:
+        _,written=apply_offset(file,offval,mode=mode,maxbytes=maxbytes)
+        size=os.path.getsize(file)
+    except ValueError as err:
+        return file,0,False,str(err)
+    except OSError as err:
+        return file,0,False,"{:s}: {:s}".format(file,str(err))
+    return file,size,written,None
+
+
+###########################################
+def write_sidecar(filename,offsets):
+    """Write the offsets to apply (image name and offset in image units per line) instead of changing any image
+    """
+    fout=open(filename,'w')
+    for Img,offval in offsets:
+        fout.write(" {:s} {:.10e} \n".format(Img,offval))
+    fout.close()
+
+
+###########################################
+def read_sidecar(filename):
+    """Read a sidecar written by write_sidecar, returns a dictionary of offsets by image name
+    """
+    offsets={}
+    f=open(filename,'r')
+    for line in f:
+        cols=line.split()
+        offsets[cols[0]]=float(cols[1])
+    f.close()
+    return offsets
+
+
+###########################################
+def read_sci(file,offsets=None,name=None):
+    """Read the SCI image of file, adding its offset from a sidecar (dictionary from read_sidecar keyed by image name,
+       default file relative to data/) when given.  Use this (or findoff --sidecar) to read images left unchanged by --mode sidecar.
+    """
+    isci=fitsio.read(file,ext='SCI')
+    if (offsets is not None):
+        if (name is None):
+            name=os.path.relpath(file,"data")
+        isci=isci+offsets[name]
+    return isci
+
 
 ################################################
 if __name__ == "__main__":
@@ -41,6 +266,10 @@ if __name__ == "__main__":
     parser.add_argument('--magzero',      action='store', type=str, default=None, help='Optional set of ZeroPoints to convert to fluxscales and to be removed from offsets')
     parser.add_argument('--magbase',      action='store', type=float, default=30.0, help='MagBase for converting magzero to fluxscale (default=30.0)')
 
+    parser.add_argument('--mode',         action='store', type=str, default='rewrite', choices=['rewrite','copy','inplace','sidecar'],
+                        help='rewrite=write all HDUs to _hack.fits (default), copy=raw copy to _hack.fits and update only SCI, inplace=update SCI of the input images (an interrupted update is resumed by the next run), sidecar=only write the offsets to <output>/<input>.sidecar')
+    parser.add_argument('--workers',      action='store', type=int, default=1, help='Number of processes applying offsets (default=1)')
+    parser.add_argument('--chunk_mb',     action='store', type=float, default=256.0, help='Memory budget (MB) per image for the SCI row blocks with --mode copy/inplace (default=256)')
     parser.add_argument('-v','--verbose', action='store', type=int, default=0,    required=False, help='Verbosity (default=0, max=2)')
     parser.add_argument('-b','--boot',    action='store_true', default=False,     required=False, help='Use bootstrap to make an intial guess)')
 
@@ -114,22 +343,47 @@ if __name__ == "__main__":
 
     file_missing=False
     ts0=time.time()
+    sidecar=[]
+    tasks=[]
     for Img in flist:
         if (os.path.isfile(os.path.join("data", Img))):
-            ih, isci, iwh, iwgt, iwh2, iwgt2, imh, imsk = get_data(os.path.join("data", Img))
-            offval=fdict[Img]['offset']/fdict[Img]['fluxscale']/64.
+            offval=fdict[Img]['offset']/fdict[Img]['fluxscale']/OFFSET_SCALE
             print(Img,fdict[Img]['offset'],fdict[Img]['fluxscale'],offval)
-            isci=isci+offval
+            if (args.mode == 'sidecar'):
+                sidecar.append((Img,offval))
+            else:
+                tasks.append((os.path.join("data", Img),offval,args.mode,int(args.chunk_mb*1024**2)))
 
-            oname=re.sub(".fits","_hack.fits",os.path.join("data", Img))
+    # apply the offsets (images that were completed by an earlier run are skipped)
+    nbytes=0
+    ndone=0
+    nfail=0
+    if (args.workers > 1):
+        with multiprocessing.Pool(args.workers) as pool:
+            results=list(pool.imap_unordered(_apply_task,tasks))
+    else:
+        results=[_apply_task(task) for task in tasks]
+    for file,size,written,err in results:
+        if (err is not None):
+            print("Error: {:s}".format(err))
+            nfail=nfail+1
+        elif (written):
+            ndone=ndone+1
+            nbytes=nbytes+size
+    ts1=time.time()
+    if (len(tasks) > 0):
+        dt=max(ts1-ts0,1.0e-6)
+        print("Applied offsets to {:d} images ({:d} already done, {:d} failed) in {:.2f} seconds: {:.2f} images/s, {:.1f} MB/s".format(
+            ndone,len(tasks)-ndone-nfail,nfail,ts1-ts0,ndone/dt,nbytes/1024.**2/dt))
 
-            ofits = fitsio.FITS(oname,'rw',clobber=True)
-            ofits.write(isci,header=ih,extname='SCI')
-            ofits.write(iwgt,header=iwh,extname='WGT')
-            ofits.write(iwgt2,header=iwh2,extname='WGT_ME')
-            ofits.write(imsk,header=imh,extname='MSK')
-            ofits.close()
+    if (args.mode == 'sidecar'):
+        os.makedirs(args.output,exist_ok=True)
+        sname=os.path.join(args.output,os.path.basename(args.input)+".sidecar")
+        write_sidecar(sname,sidecar)
+        print("Wrote offsets for {:d} images to {:s}".format(len(sidecar),sname))
 
+    if (nfail > 0):
+        exit(1)
     exit(0)
 
 